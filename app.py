@@ -11,6 +11,8 @@ from werkzeug.security import check_password_hash, generate_password_hash
 
 import psycopg2
 import psycopg2.extras
+import psycopg2.errors
+import psycopg2.pool
 import csv
 from io import StringIO
 from flask import Response
@@ -50,16 +52,1111 @@ login_manager.init_app(app)
 login_manager.login_view = "login"
 
 # ================== DB ==================
-def get_db():
+import re
+import select
+import threading
+import time
+from functools import wraps
+from flask import g, has_request_context
+
+# Cada ruta pertenece a una clase de consulta con su propio statement_timeout
+# y un máximo de requests en paralelo por proceso (None = sin límite).
+# Las escrituras (nuevo llamado, resolver, ...) no tienen tope ni cuentan
+# contra el cupo de lecturas: siempre tienen lugar primero.
+# Los cupos son por proceso: el deploy corre gunicorn con workers gthread y
+# GUNICORN_THREADS threads cada uno (templates/render.yaml), y los cupos se
+# dimensionan contra esa cantidad.
+GUNICORN_THREADS = int(os.environ.get("GUNICORN_THREADS", 8))
+
+# Tope de lecturas (todas las clases menos escritura) en vuelo por proceso,
+# dejando siempre threads libres para las escrituras
+LECTURAS_MAX_CONCURRENTES = int(
+    os.environ.get("LECTURAS_MAX_CONCURRENTES", max(GUNICORN_THREADS - 2, 1))
+)
+
+CLASES_CONSULTA = {
+    "interactiva": {
+        "timeout_ms": int(os.environ.get("TIMEOUT_INTERACTIVA_MS", 5000)),
+        "max_concurrentes": int(os.environ.get("MAX_INTERACTIVA", LECTURAS_MAX_CONCURRENTES)),
+        "retry_after": 2
+    },
+    "dashboard": {
+        "timeout_ms": int(os.environ.get("TIMEOUT_DASHBOARD_MS", 15000)),
+        "max_concurrentes": int(os.environ.get("MAX_DASHBOARD", 2)),
+        "retry_after": 5
+    },
+    "export": {
+        "timeout_ms": int(os.environ.get("TIMEOUT_EXPORT_MS", 120000)),
+        "max_concurrentes": int(os.environ.get("MAX_EXPORT", 1)),
+        "retry_after": 30
+    },
+    "escritura": {
+        "timeout_ms": int(os.environ.get("TIMEOUT_ESCRITURA_MS", 5000)),
+        "max_concurrentes": None,
+        "retry_after": 1
+    }
+}
+CLASE_CONSULTA_DEFAULT = "interactiva"
+
+_en_vuelo = {clase: 0 for clase in CLASES_CONSULTA}
+_en_vuelo_lock = threading.Lock()
+
+
+def _tomar_cupo(clase):
+    limite = CLASES_CONSULTA[clase]["max_concurrentes"]
+
+    with _en_vuelo_lock:
+        if limite is not None:
+            lecturas = sum(n for c, n in _en_vuelo.items() if c != "escritura")
+            if _en_vuelo[clase] >= limite or lecturas >= LECTURAS_MAX_CONCURRENTES:
+                return False
+        _en_vuelo[clase] += 1
+        return True
+
+
+def _liberar_cupo(clase):
+    with _en_vuelo_lock:
+        _en_vuelo[clase] -= 1
+
+
+def _respuesta_sobrecarga(mensaje, retry_after):
+    headers = {"Retry-After": str(retry_after)}
+
+    if request.accept_mimetypes.best == "application/json" or request.path.startswith("/reporte/"):
+        return jsonify({"error": mensaje}), 503, headers
+
+    return Response(mensaje, status=503, mimetype="text/plain", headers=headers)
+
+
+def clase_consulta(clase):
+    """Asigna la clase de consulta a la ruta y rechaza rápido (503) si no hay cupo."""
+    def decorador(f):
+        @wraps(f)
+        def envuelta(*args, **kwargs):
+            if not _tomar_cupo(clase):
+                return _respuesta_sobrecarga(
+                    "Servidor ocupado, probá de nuevo en unos segundos",
+                    CLASES_CONSULTA[clase]["retry_after"]
+                )
+
+            g.clase_consulta = clase
+            try:
+                return f(*args, **kwargs)
+            finally:
+                _liberar_cupo(clase)
+        return envuelta
+    return decorador
+
+
+# ================== BACKENDS ==================
+# Una sola API de consultas (get_db() -> .cursor() -> execute con %s y filas
+# como dict) sobre Postgres o SQLite embebido. DATABASE_URL elige el backend:
+#   postgresql://...          -> Postgres
+#   sqlite:///database.db     -> SQLite (ruta relativa a la app)
+#   sqlite:////var/lib/x.db   -> SQLite (ruta absoluta)
+# Lo que cambia entre motores (fechas, NOTIFY, locks, inserts masivos) lo
+# resuelve el backend; las rutas escriben SQL portable.
+import fcntl
+import sqlite3
+
+SQLITE_AVISOS_POLL_SEG = 5
+
+# Conexiones persistentes a Postgres por proceso. Si el pool está agotado se
+# abre una conexión suelta que se cierra al terminar.
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 10))
+
+
+# Medición de sentencias / filas del thread actual (tests/test_presupuestos.py).
+# Sin medición activa no cuesta más que un getattr.
+_medicion = threading.local()
+
+
+class ConsultaCancelada(Exception):
+    """La consulta superó el statement_timeout de su clase (cualquier backend)."""
+
+
+class ConexionPreparada(psycopg2.extensions.connection):
+    """Conexión de Postgres que recuerda qué sentencias ya tiene preparadas."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparadas = set()
+        self.timeout_ms = None
+
+
+class ConexionPool:
+    """Conexión prestada por el pool: close() la devuelve en vez de cerrarla."""
+
+    def __init__(self, pool, raw):
+        self.pool = pool
+        self.raw = raw
+
+    def __getattr__(self, nombre):
+        return getattr(self.raw, nombre)
+
+    @property
+    def autocommit(self):
+        return self.raw.autocommit
+
+    @autocommit.setter
+    def autocommit(self, valor):
+        self.raw.autocommit = valor
+
+    @property
+    def closed(self):
+        return self.raw is None or self.raw.closed
+
+    def close(self):
+        if self.raw is None:
+            return
+        raw, self.raw = self.raw, None
+
+        if raw.closed:
+            self.pool.putconn(raw, close=True)
+            return
+
+        try:
+            # Vuelve al pool sin transacción abierta ni cambios de sesión
+            if raw.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                raw.rollback()
+            raw.autocommit = False
+            self.pool.putconn(raw)
+        except psycopg2.Error:
+            self.pool.putconn(raw, close=True)
+
+
+class BackendPostgres:
+    nombre = "postgres"
+    soporta_rollup = True
+    hoy = "CURRENT_DATE"
+    inicio_semana = "date_trunc('week', CURRENT_DATE)"
+    esquema = []
+
+    def __init__(self, url):
+        self.url = url
+        self.pool = None
+        self.pool_pid = None
+        self.pool_lock = threading.Lock()
+
+    def _pool_proceso(self):
+        # Un pool por proceso: con gunicorn --preload el del master no sirve
+        # en los workers
+        if self.pool is None or self.pool_pid != os.getpid():
+            with self.pool_lock:
+                if self.pool is None or self.pool_pid != os.getpid():
+                    self.pool = psycopg2.pool.ThreadedConnectionPool(
+                        DB_POOL_MIN,
+                        DB_POOL_MAX,
+                        self.url,
+                        cursor_factory=psycopg2.extras.RealDictCursor,
+                        connection_factory=ConexionPreparada
+                    )
+                    self.pool_pid = os.getpid()
+        return self.pool
+
+    def conectar(self, timeout_ms, dedicada=False):
+        """
+        dedicada=True: conexión propia fuera del pool (LISTEN, advisory locks
+        de sesión, procesos largos).
+        """
+        if dedicada:
+            raw = psycopg2.connect(
+                self.url,
+                cursor_factory=psycopg2.extras.RealDictCursor,
+                connection_factory=ConexionPreparada,
+                options=f"-c statement_timeout={timeout_ms}"
+            )
+            raw.timeout_ms = timeout_ms
+            return raw
+
+        pool = self._pool_proceso()
+
+        for _ in range(2):
+            try:
+                raw = pool.getconn()
+            except psycopg2.pool.PoolError:
+                return self.conectar(timeout_ms, dedicada=True)
+
+            try:
+                # statement_timeout de la clase; solo si cambió desde el último uso
+                if raw.timeout_ms != timeout_ms:
+                    with raw.cursor() as cur:
+                        cur.execute("SET statement_timeout = %s", (timeout_ms,))
+                    raw.commit()
+                    raw.timeout_ms = timeout_ms
+                return ConexionPool(pool, raw)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # Conexión caída (reinicio del servidor, idle timeout): se
+                # descarta y el pool abre otra, sin sentencias preparadas
+                pool.putconn(raw, close=True)
+
+        return self.conectar(timeout_ms, dedicada=True)
+
+    def ejecutar_preparada(self, cur, nombre, params):
+        conn = cur.connection
+        sql, marcadores = _SENTENCIAS_POSTGRES[nombre]
+        en_transaccion = conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+        if nombre not in conn.preparadas:
+            cur.execute(f"PREPARE {nombre} AS {sql}")
+            conn.preparadas.add(nombre)
+
+        try:
+            cur.execute(f"EXECUTE {nombre} ({marcadores})", params)
+        except psycopg2.errors.InvalidSqlStatementName:
+            # La sesión perdió sus sentencias (DISCARD ALL de un pooler
+            # externo). Fuera de una transacción se vuelve a preparar.
+            conn.preparadas.clear()
+            if en_transaccion:
+                raise
+            conn.rollback()
+            self.ejecutar_preparada(cur, nombre, params)
+
+    # ---------- DIALECTO ----------
+    def minutos_entre(self, desde, hasta):
+        return f"(EXTRACT(EPOCH FROM ({hasta} - {desde})) / 60)"
+
+    def trunc(self, unidad, columna):
+        return f"date_trunc('{unidad}', {columna})"
+
+    def bin_histograma(self, minutos):
+        limites = ", ".join(str(l) for l in HISTOGRAMA_LIMITES)
+        return f"""(
+            SELECT COUNT(*)
+            FROM unnest(ARRAY[{limites}]::double precision[]) AS limite
+            WHERE limite < {minutos}
+        )"""
+
+    def ejecutar_varios(self, cur, sql, filas, page_size=1000):
+        """sql con un único 'VALUES %s': un INSERT multi-fila por página."""
+        psycopg2.extras.execute_values(cur, sql, filas, page_size=page_size)
+
+    def ddl(self, cur, sql):
+        # ALTER TABLE toma ACCESS EXCLUSIVE aunque la columna ya exista:
+        # se consulta el catálogo antes
+        m = _ADD_COLUMN.match(sql)
+        if m:
+            tabla, columna, _ = m.groups()
+            cur.execute("""
+                SELECT 1
+                FROM information_schema.columns
+                WHERE table_schema = current_schema()
+                AND table_name = %s
+                AND column_name = %s
+            """, (tabla, columna))
+            if cur.fetchone():
+                return
+
+        cur.execute(sql)
+
+    def estimar_filas(self, cur, desde_sql, params):
+        """Filas estimadas por el planner (estadísticas de ANALYZE), sin recorrer la tabla."""
+        cur.execute(f"EXPLAIN (FORMAT JSON) SELECT 1 {desde_sql}", params)
+        plan = cur.fetchone()["QUERY PLAN"]
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    def para_actualizar(self, cur):
+        """Sufijo de un SELECT que bloquea las filas leídas hasta el commit."""
+        return "FOR UPDATE"
+
+    # ---------- LÍDER / AVISOS ----------
+    def bloquear(self, cur, lock_id):
+        """Serializa entre procesos a quienes toman el mismo lock, hasta el commit."""
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (lock_id,))
+
+    def tomar_liderazgo(self, db, cur, lock_id):
+        cur.execute("SELECT pg_try_advisory_lock(%s) AS lider", (lock_id,))
+        return cur.fetchone()["lider"]
+
+    def escuchar(self, db, cur, canal):
+        cur.execute(f"LISTEN {canal}")
+
+    def notificar(self, cur, canal, payload):
+        cur.execute("SELECT pg_notify(%s, %s)", (canal, payload))
+
+    def esperar_avisos(self, db, cur, canal, espera):
+        select.select([db], [], [], espera)
+        db.poll()
+
+        payloads = []
+        while db.notifies:
+            payloads.append(db.notifies.pop(0).payload)
+        return payloads
+
+
+def _convertir_fecha(valor):
+    return datetime.fromisoformat(valor.decode())
+
+
+def _date_trunc_sqlite(unidad, valor):
+    if valor is None:
+        return None
+    fecha = datetime.fromisoformat(valor)
+    if unidad == "hour":
+        fecha = fecha.replace(minute=0, second=0, microsecond=0)
+    elif unidad == "day":
+        fecha = fecha.replace(hour=0, minute=0, second=0, microsecond=0)
+    elif unidad == "week":
+        fecha = fecha.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=fecha.weekday())
+    elif unidad == "month":
+        fecha = fecha.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return fecha.isoformat(" ")
+
+
+sqlite3.register_adapter(datetime, lambda d: d.isoformat(" "))
+sqlite3.register_converter("TIMESTAMP", _convertir_fecha)
+sqlite3.register_converter("DATETIME", _convertir_fecha)
+sqlite3.register_converter("BOOLEAN", lambda v: v not in (b"0", b""))
+
+_PLACEHOLDER = re.compile(r"%(s|%)")
+_ADD_COLUMN = re.compile(r"\s*ALTER TABLE (\w+) ADD COLUMN IF NOT EXISTS (\w+) (.+)", re.S)
+
+
+class CursorSQLite:
+    """Cursor con la misma cara que RealDictCursor: %s como placeholder y filas dict."""
+
+    def __init__(self, conexion):
+        self.conexion = conexion
+        self.cur = conexion.raw.cursor()
+        self.itersize = None
+
+    def _sql(self, sql, params):
+        # Igual que psycopg2: sin parámetros el % va literal
+        if params is None:
+            return sql
+        return _PLACEHOLDER.sub(lambda m: "?" if m.group(1) == "s" else "%", sql)
+
+    def _medir(self, sentencias=0, filas=0):
+        medicion = getattr(_medicion, "actual", None)
+        if medicion is not None:
+            medicion.sentencias += sentencias
+            medicion.filas += filas
+
+    def _ejecutar(self, funcion, sql, params):
+        self._medir(sentencias=1)
+        self.conexion.arrancar_timeout()
+        try:
+            funcion(self._sql(sql, params), params if params is not None else ())
+        except sqlite3.OperationalError as e:
+            if str(e) == "interrupted":
+                raise ConsultaCancelada(str(e)) from e
+            raise
+
+    def execute(self, sql, params=None):
+        self._ejecutar(self.cur.execute, sql, params)
+
+    def executemany(self, sql, filas):
+        self._ejecutar(self.cur.executemany, sql, filas)
+
+    def fetchone(self):
+        fila = self.cur.fetchone()
+        self._medir(filas=fila is not None)
+        return fila
+
+    def fetchall(self):
+        filas = self.cur.fetchall()
+        self._medir(filas=len(filas))
+        return filas
+
+    def __iter__(self):
+        for fila in self.cur:
+            self._medir(filas=1)
+            yield fila
+
+    @property
+    def rowcount(self):
+        return self.cur.rowcount
+
+    def close(self):
+        self.cur.close()
+
+
+class ConexionSQLite:
+    def __init__(self, raw, timeout_ms):
+        self.raw = raw
+        self.timeout_ms = timeout_ms
+        self.vence = None
+        self.locks = []
+        self.ultimo_aviso = 0
+
+        # statement_timeout: el progress handler corta la consulta al vencer
+        raw.set_progress_handler(self._vencida, 10000)
+
+    def _vencida(self):
+        return self.vence is not None and time.monotonic() > self.vence
+
+    def arrancar_timeout(self):
+        self.vence = time.monotonic() + self.timeout_ms / 1000 if self.timeout_ms else None
+
+    def cursor(self, name=None):
+        # name (cursor del lado del servidor en Postgres): sqlite ya itera de a una fila
+        return CursorSQLite(self)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    @property
+    def autocommit(self):
+        return self.raw.isolation_level is None
+
+    @autocommit.setter
+    def autocommit(self, valor):
+        self.raw.isolation_level = None if valor else ""
+
+    @property
+    def closed(self):
+        return self.raw is None
+
+    def close(self):
+        if self.raw is None:
+            return
+        for archivo in self.locks:
+            archivo.close()
+        self.locks = []
+        self.raw.close()
+        self.raw = None
+
+
+class BackendSQLite:
+    nombre = "sqlite"
+    soporta_rollup = False
+    hoy = "DATE('now', 'localtime')"
+    inicio_semana = "DATE('now', 'localtime', '-6 days', 'weekday 1')"
+    esquema = ["""
+        CREATE TABLE IF NOT EXISTS avisos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            canal TEXT NOT NULL,
+            payload TEXT
+        )
+    """]
+
+    PRAGMAS = (
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA busy_timeout = 5000",
+        "PRAGMA foreign_keys = ON",
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA cache_size = -16000",
+        "PRAGMA mmap_size = 268435456"
+    )
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+
+    def conectar(self, timeout_ms, dedicada=False):
+        raw = sqlite3.connect(
+            self.ruta,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            timeout=5
+        )
+        raw.row_factory = lambda cur, row: {
+            col[0]: valor for col, valor in zip(cur.description, row)
+        }
+
+        for pragma in self.PRAGMAS:
+            raw.execute(pragma)
+
+        raw.create_function("NOW", 0, lambda: datetime.now().isoformat(" "))
+        raw.create_function("date_trunc", 2, _date_trunc_sqlite, deterministic=True)
+        raw.create_function("GREATEST", -1, lambda *valores: max(valores), deterministic=True)
+        raw.create_function("bin_histograma", 1, _bin_minutos, deterministic=True)
+
+        return ConexionSQLite(raw, timeout_ms)
+
+    # ---------- DIALECTO ----------
+    def minutos_entre(self, desde, hasta):
+        return f"((julianday({hasta}) - julianday({desde})) * 1440)"
+
+    def trunc(self, unidad, columna):
+        return f"date_trunc('{unidad}', {columna})"
+
+    def bin_histograma(self, minutos):
+        return f"bin_histograma({minutos})"
+
+    def ejecutar_varios(self, cur, sql, filas, page_size=1000):
+        if not filas:
+            return
+        placeholders = "(" + ", ".join(["%s"] * len(filas[0])) + ")"
+        cur.executemany(sql.replace("VALUES %s", f"VALUES {placeholders}"), filas)
+
+    def ddl(self, cur, sql):
+        sql = sql.replace("SERIAL PRIMARY KEY", "INTEGER PRIMARY KEY AUTOINCREMENT")
+        sql = sql.replace("DEFAULT NOW()", "DEFAULT (datetime('now', 'localtime'))")
+
+        # SQLite no tiene ADD COLUMN IF NOT EXISTS
+        m = _ADD_COLUMN.match(sql)
+        if m:
+            tabla, columna, tipo = m.groups()
+            cur.execute(f"PRAGMA table_info({tabla})")
+            if any(c["name"] == columna for c in cur.fetchall()):
+                return
+            sql = f"ALTER TABLE {tabla} ADD COLUMN {columna} {tipo.strip()}"
+
+        cur.execute(sql)
+
+    def estimar_filas(self, cur, desde_sql, params):
+        # SQLite no expone estimaciones del planner: queda el conteo con tope
+        return None
+
+    def ejecutar_preparada(self, cur, nombre, params):
+        # sqlite3 ya guarda las sentencias compiladas por conexión
+        # (cached_statements): alcanza con repetir el mismo texto
+        sql = SENTENCIAS_PREPARADAS[nombre]
+        if "{para_actualizar}" in sql:
+            sql = sql.replace("{para_actualizar}", self.para_actualizar(cur))
+        cur.execute(sql, params)
+
+    def para_actualizar(self, cur):
+        # Sin FOR UPDATE: se toma el lock de escritura de toda la base antes
+        # de leer, así nadie cambia la fila entre el SELECT y el UPDATE
+        if not cur.conexion.raw.in_transaction:
+            cur.execute("BEGIN IMMEDIATE")
+        return ""
+
+    # ---------- LÍDER / AVISOS ----------
+    def bloquear(self, cur, lock_id):
+        # Un solo escritor por archivo: tomar el lock de escritura ya serializa
+        if not cur.conexion.raw.in_transaction:
+            cur.execute("BEGIN IMMEDIATE")
+
+    def tomar_liderazgo(self, db, cur, lock_id):
+        # flock en un archivo al lado de la base: se libera si muere el proceso
+        archivo = open(f"{self.ruta}.lider-{lock_id}.lock", "w")
+        try:
+            fcntl.flock(archivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            archivo.close()
+            return False
+
+        db.locks.append(archivo)
+        return True
+
+    def escuchar(self, db, cur, canal):
+        cur.execute("SELECT COALESCE(MAX(id), 0) AS ultimo FROM avisos WHERE canal = %s", (canal,))
+        db.ultimo_aviso = cur.fetchone()["ultimo"]
+
+    def notificar(self, cur, canal, payload):
+        cur.execute("INSERT INTO avisos (canal, payload) VALUES (%s, %s)", (canal, payload))
+
+    def esperar_avisos(self, db, cur, canal, espera):
+        # Sin LISTEN/NOTIFY: se consulta la tabla de avisos (por PK) cada pocos segundos
+        time.sleep(min(espera, SQLITE_AVISOS_POLL_SEG))
+
+        cur.execute("""
+            SELECT id, payload
+            FROM avisos
+            WHERE canal = %s
+            AND id > %s
+            ORDER BY id
+        """, (canal, db.ultimo_aviso))
+        avisos = cur.fetchall()
+
+        if avisos:
+            db.ultimo_aviso = avisos[-1]["id"]
+            cur.execute("DELETE FROM avisos WHERE canal = %s AND id <= %s", (canal, db.ultimo_aviso))
+
+        return [a["payload"] for a in avisos]
+
+
+def crear_backend(url):
+    if not url:
+        return None
+
+    if url.startswith("sqlite:///"):
+        ruta = url[len("sqlite:///"):]
+        if not os.path.isabs(ruta):
+            ruta = os.path.join(app.root_path, ruta)
+        return BackendSQLite(ruta)
+
+    return BackendPostgres(url)
+
+
+backend = crear_backend(DATABASE_URL)
+
+
+def get_db(clase=None, dedicada=False):
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL no está configurada")
 
-    return psycopg2.connect(
-        DATABASE_URL,
-        cursor_factory=psycopg2.extras.RealDictCursor
+    if clase is None:
+        clase = g.get("clase_consulta", CLASE_CONSULTA_DEFAULT) if has_request_context() else CLASE_CONSULTA_DEFAULT
+
+    db = backend.conectar(CLASES_CONSULTA[clase]["timeout_ms"], dedicada=dedicada)
+
+    # Las conexiones del request vuelven al pool al terminar aunque la ruta
+    # se olvide de cerrarlas (o salga por una excepción)
+    if has_request_context() and not dedicada:
+        g.setdefault("conexiones", []).append(db)
+
+    return db
+
+
+@app.teardown_request
+def devolver_conexiones(exc):
+    for db in g.pop("conexiones", []):
+        if not db.closed:
+            db.close()
+
+
+# ================== SENTENCIAS PREPARADAS ==================
+# Consultas de forma fija que corren miles de veces por día. En Postgres se
+# preparan una vez por conexión del pool (PREPARE) y después se ejecutan por
+# nombre, sin parsear ni planificar de nuevo. Una conexión nueva del pool
+# arranca sin ninguna y las prepara en su primer uso.
+# {para_actualizar} lo completa el backend (ver para_actualizar()).
+SENTENCIAS_PREPARADAS = {
+    "usuario_por_id": """
+        SELECT * FROM usuarios WHERE id = %s
+    """,
+    "login_usuario": """
+        SELECT id, username, password_hash, es_admin
+        FROM usuarios
+        WHERE username = %s
+        AND activo = true
+    """,
+    "historial_propio_contar": """
+        SELECT COUNT(*) AS total
+        FROM (SELECT 1 FROM guardias WHERE quien_guardia = %s LIMIT %s) t
+    """,
+    "historial_propio_todo": """
+        SELECT *
+        FROM guardias
+        WHERE quien_guardia = %s
+        ORDER BY fecha_registro DESC
+    """,
+    "historial_propio_pagina": """
+        SELECT *
+        FROM guardias
+        WHERE quien_guardia = %s
+        ORDER BY fecha_registro DESC
+        LIMIT %s OFFSET %s
+    """,
+    "guardia_para_resolver": """
+        SELECT quien_guardia, prioridad, estado, fecha_llamado, fecha_resolucion
+        FROM guardias
+        WHERE id = %s
+        {para_actualizar}
+    """,
+    "guardia_resolver": """
+        UPDATE guardias
+        SET estado = 'Resuelto',
+            fecha_resolucion = NOW()
+        WHERE id = %s
+        RETURNING estado, fecha_llamado, fecha_resolucion, quien_guardia, prioridad
+    """,
+    "guardia_insertar": """
+        INSERT INTO guardias (
+            quien_llamo,
+            fecha_llamado,
+            quien_guardia,
+            descripcion,
+            prioridad,
+            fecha_registro,
+            fecha_resolucion,
+            derivado,
+            derivado_a,
+            estado
+        )
+        VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+        RETURNING id
+    """
+}
+
+
+def _sentencia_postgres(sql):
+    """%s -> $1, $2, ... para PREPARE. Devuelve (sql, marcadores de EXECUTE)."""
+    n = 0
+
+    def numerar(m):
+        nonlocal n
+        n += 1
+        return f"${n}"
+
+    sql = re.sub(r"%s", numerar, sql.replace("{para_actualizar}", "FOR UPDATE"))
+    return sql, ", ".join(["%s"] * n)
+
+
+_SENTENCIAS_POSTGRES = {
+    nombre: _sentencia_postgres(sql) for nombre, sql in SENTENCIAS_PREPARADAS.items()
+}
+
+
+def ejecutar_preparada(cur, nombre, params):
+    """cur.execute() de una sentencia de SENTENCIAS_PREPARADAS, por nombre."""
+    backend.ejecutar_preparada(cur, nombre, params)
+
+
+@app.errorhandler(psycopg2.errors.QueryCanceled)
+@app.errorhandler(ConsultaCancelada)
+def consulta_cancelada(e):
+    clase = g.get("clase_consulta", CLASE_CONSULTA_DEFAULT)
+    app.logger.warning("Consulta cancelada por statement_timeout (%s): %s", clase, request.path)
+    return _respuesta_sobrecarga(
+        "La consulta tardó demasiado, probá con filtros más acotados",
+        CLASES_CONSULTA[clase]["retry_after"]
     )
 
 
+# ================== CACHE DE FRAGMENTOS ==================
+# HTML ya renderizado de dashboard / historial. Clave: ruta + filtros + rol +
+# usuario (la navbar muestra el nombre). Se vence por TTL, se desaloja por LRU
+# y las rutas que escriben en guardias la vacían para que un llamado recién
+# cargado se vea al instante.
+#
+# Todos los cachés tienen la misma cara (get / set / clear / stats) y
+# CACHE_BACKEND elige dónde viven:
+#   local   -> LRU en memoria de cada proceso (un worker, desarrollo)
+#   archivo -> SQLite en memoria compartida (/dev/shm, mmap): un solo caché
+#              para todos los workers de la máquina
+#   redis   -> servidor Redis (o compatible) en CACHE_URL
+# Con archivo / redis un clear() en un worker lo ven todos los demás.
+# Fuera del proceso los valores (HTML, tuplas de conteo) se guardan como
+# JSON, nunca con pickle: lo que se lee del archivo / Redis no puede
+# ejecutar código en la app.
+from collections import OrderedDict
+import json
+import stat
+
+CACHE_FRAGMENTOS_TTL_SEG = int(os.environ.get("CACHE_FRAGMENTOS_TTL_SEG", 60))
+CACHE_FRAGMENTOS_MAX = int(os.environ.get("CACHE_FRAGMENTOS_MAX", 256))
+
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "local")
+CACHE_URL = os.environ.get("CACHE_URL", "redis://localhost:6379/0")
+# Sin CACHE_ARCHIVO: /dev/shm/guardias_<uid>/ (directorio 0700 propio) o,
+# sin /dev/shm, al lado de la app
+CACHE_ARCHIVO = os.environ.get("CACHE_ARCHIVO")
+CACHE_ARCHIVO_USADO_SEG = 10
+CACHE_ARCHIVO_ESPERA_SEG = 0.1
+
+
+class CacheLRU:
+    def __init__(self, max_items, ttl):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.items = OrderedDict()   # clave -> (vence, valor)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, clave):
+        with self.lock:
+            item = self.items.get(clave)
+
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self.items[clave]
+                self.misses += 1
+                return None
+
+            self.items.move_to_end(clave)
+            self.hits += 1
+            return item[1]
+
+    def set(self, clave, valor):
+        with self.lock:
+            self.items[clave] = (time.monotonic() + self.ttl, valor)
+            self.items.move_to_end(clave)
+
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        with self.lock:
+            consultas = self.hits + self.misses
+            return {
+                "backend": "local",
+                "items": len(self.items),
+                "max_items": self.max_items,
+                "ttl_seg": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / consultas, 3) if consultas else None
+            }
+
+
+def _directorio_cache_archivo():
+    if not os.path.isdir("/dev/shm"):
+        return app.root_path
+
+    # /dev/shm lo puede escribir cualquier usuario: el archivo va en un
+    # directorio propio que nadie más puede crear ni tocar
+    directorio = f"/dev/shm/guardias_{os.getuid()}"
+    os.makedirs(directorio, mode=0o700, exist_ok=True)
+    st = os.lstat(directorio)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError(f"{directorio} no es un directorio privado de este usuario")
+    return directorio
+
+
+def _preparar_archivo_cache(ruta):
+    """Crea el archivo del caché con permisos 0600 (o verifica que sea nuestro)."""
+    fd = os.open(ruta, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+    try:
+        if os.fstat(fd).st_uid != os.getuid():
+            raise RuntimeError(f"CACHE_ARCHIVO {ruta} es de otro usuario")
+        os.fchmod(fd, 0o600)
+    finally:
+        os.close(fd)
+
+
+class CacheArchivo:
+    """
+    LRU con TTL en una base SQLite compartida por todos los procesos de la
+    máquina. En /dev/shm el archivo vive en memoria y se lee por mmap. Si el
+    archivo está ocupado o roto se responde como miss: el caché nunca tira
+    abajo un request.
+    """
+
+    def __init__(self, ruta, espacio, max_items, ttl):
+        self.ruta = ruta or os.path.join(_directorio_cache_archivo(), "guardias_cache.db")
+        _preparar_archivo_cache(self.ruta)
+        self.espacio = espacio
+        self.max_items = max_items
+        self.ttl = ttl
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    def _db(self):
+        # Una conexión por thread y por proceso (no sobrevive a un fork)
+        if getattr(self.local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.ruta, timeout=CACHE_ARCHIVO_ESPERA_SEG, isolation_level=None)
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = OFF")
+            db.execute("PRAGMA mmap_size = 67108864")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    espacio TEXT NOT NULL,
+                    clave TEXT NOT NULL,
+                    vence REAL NOT NULL,
+                    usado REAL NOT NULL,
+                    valor BLOB NOT NULL,
+                    PRIMARY KEY (espacio, clave)
+                ) WITHOUT ROWID
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS idx_cache_usado ON cache (espacio, usado)")
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return self.local.db
+
+    def get(self, clave):
+        try:
+            db = self._db()
+            fila = db.execute(
+                "SELECT vence, usado, valor FROM cache WHERE espacio = ? AND clave = ?",
+                (self.espacio, repr(clave))
+            ).fetchone()
+
+            ahora = time.time()
+            if fila is None or fila[0] < ahora:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            valor = json.loads(fila[2])
+
+            # LRU aproximado: un hit solo escribe si "usado" tiene más de
+            # CACHE_ARCHIVO_USADO_SEG. Así los hits casi nunca compiten por
+            # el único lock de escritura del archivo
+            if ahora - fila[1] > CACHE_ARCHIVO_USADO_SEG:
+                try:
+                    db.execute(
+                        "UPDATE cache SET usado = ? WHERE espacio = ? AND clave = ?",
+                        (ahora, self.espacio, repr(clave))
+                    )
+                except sqlite3.OperationalError:
+                    # Otro worker escribiendo: se actualiza en el próximo hit
+                    pass
+
+            return valor
+        except sqlite3.Error:
+            app.logger.exception("Caché compartido (%s): get falló", self.espacio)
+            self.misses += 1
+            return None
+
+    def set(self, clave, valor):
+        try:
+            db = self._db()
+            ahora = time.time()
+            db.execute(
+                "INSERT OR REPLACE INTO cache (espacio, clave, vence, usado, valor) VALUES (?, ?, ?, ?, ?)",
+                (self.espacio, repr(clave), ahora + self.ttl, ahora, json.dumps(valor))
+            )
+            # Desaloja los menos usados por encima de max_items
+            db.execute("""
+                DELETE FROM cache
+                WHERE espacio = ?
+                AND clave IN (
+                    SELECT clave FROM cache
+                    WHERE espacio = ?
+                    ORDER BY usado DESC
+                    LIMIT -1 OFFSET ?
+                )
+            """, (self.espacio, self.espacio, self.max_items))
+        except sqlite3.Error:
+            app.logger.exception("Caché compartido (%s): set falló", self.espacio)
+
+    def clear(self):
+        try:
+            self._db().execute("DELETE FROM cache WHERE espacio = ?", (self.espacio,))
+        except sqlite3.Error:
+            app.logger.exception("Caché compartido (%s): clear falló", self.espacio)
+
+    def stats(self):
+        try:
+            items = self._db().execute(
+                "SELECT COUNT(*) FROM cache WHERE espacio = ?", (self.espacio,)
+            ).fetchone()[0]
+        except sqlite3.Error:
+            items = None
+
+        consultas = self.hits + self.misses
+        return {
+            "backend": "archivo",
+            "archivo": self.ruta,
+            "items": items,
+            "max_items": self.max_items,
+            "ttl_seg": self.ttl,
+            # hits / misses son de este worker
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / consultas, 3) if consultas else None
+        }
+
+
+class CacheRedis:
+    """
+    Caché en Redis. clear() no borra claves: sube la generación del espacio
+    y las entradas viejas quedan inalcanzables hasta que vence su TTL. El
+    desalojo por memoria lo hace Redis (maxmemory-policy allkeys-lru).
+    """
+
+    def __init__(self, url, espacio, max_items, ttl):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_BACKEND=redis necesita el paquete redis (pip install redis)")
+
+        self.redis = redis.Redis.from_url(url, socket_timeout=0.5)
+        self.error_redis = redis.RedisError
+        self.espacio = espacio
+        self.max_items = max_items
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _clave(self, clave):
+        generacion = self.redis.get(f"guardias:{self.espacio}:gen") or b"0"
+        return f"guardias:{self.espacio}:{generacion.decode()}:{clave!r}"
+
+    def get(self, clave):
+        try:
+            valor = self.redis.get(self._clave(clave))
+        except self.error_redis:
+            app.logger.exception("Caché compartido (%s): get falló", self.espacio)
+            valor = None
+
+        if valor is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return json.loads(valor)
+
+    def set(self, clave, valor):
+        try:
+            self.redis.set(self._clave(clave), json.dumps(valor), ex=self.ttl)
+        except self.error_redis:
+            app.logger.exception("Caché compartido (%s): set falló", self.espacio)
+
+    def clear(self):
+        try:
+            self.redis.incr(f"guardias:{self.espacio}:gen")
+        except self.error_redis:
+            app.logger.exception("Caché compartido (%s): clear falló", self.espacio)
+
+    def stats(self):
+        consultas = self.hits + self.misses
+        return {
+            "backend": "redis",
+            "max_items": self.max_items,
+            "ttl_seg": self.ttl,
+            # hits / misses son de este worker
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / consultas, 3) if consultas else None
+        }
+
+
+def crear_cache(espacio, max_items, ttl):
+    if CACHE_BACKEND == "archivo":
+        return CacheArchivo(CACHE_ARCHIVO, espacio, max_items, ttl)
+    if CACHE_BACKEND == "redis":
+        return CacheRedis(CACHE_URL, espacio, max_items, ttl)
+    if CACHE_BACKEND == "local":
+        return CacheLRU(max_items, ttl)
+    raise RuntimeError(f"CACHE_BACKEND desconocido: {CACHE_BACKEND}")
+
+
+cache_fragmentos = crear_cache("fragmentos", CACHE_FRAGMENTOS_MAX, CACHE_FRAGMENTOS_TTL_SEG)
+
+
+def invalidar_cache_guardias():
+    cache_fragmentos.clear()
+    cache_conteos.clear()
+
+
+def cache_fragmento(condicion=None):
+    """Cachea el HTML que devuelve la ruta (solo GET y solo si se cumple condicion())."""
+    def decorador(f):
+        @wraps(f)
+        def envuelta(*args, **kwargs):
+            if request.method != "GET" or (condicion and not condicion()):
+                return f(*args, **kwargs)
+
+            clave = (
+                request.endpoint,
+                tuple(sorted(request.args.items(multi=True))),
+                "admin" if current_user.es_admin else "guardia",
+                current_user.username
+            )
+
+            html = cache_fragmentos.get(clave)
+            if html is not None:
+                return Response(html, headers={"X-Cache": "HIT"})
+
+            resultado = f(*args, **kwargs)
+
+            # Solo se guarda HTML renderizado (no redirects ni errores)
+            if isinstance(resultado, str):
+                cache_fragmentos.set(clave, resultado)
+                return Response(resultado, headers={"X-Cache": "MISS"})
+
+            return resultado
+        return envuelta
+    return decorador
+
+
+@app.route("/admin/cache")
+@login_required
+def estadisticas_cache():
+    if not current_user.es_admin:
+        abort(403)
+
+    return jsonify({
+        "fragmentos": cache_fragmentos.stats(),
+        "conteos": cache_conteos.stats()
+    })
+
+
 # ================== USUARIOS ==================
 class User(UserMixin):
     def __init__(self, id, username, password, es_admin):
@@ -72,10 +1169,7 @@ class User(UserMixin):
 def load_user(user_id):
     db = get_db()
     cur = db.cursor()
-    cur.execute(
-        "SELECT * FROM usuarios WHERE id = %s",
-        (user_id,)
-    )
+    ejecutar_preparada(cur, "usuario_por_id", (user_id,))
     user = cur.fetchone()
     db.close()
 
@@ -105,12 +1199,7 @@ def login():
         db = get_db()
         cur = db.cursor()
 
-        cur.execute("""
-            SELECT id, username, password_hash, es_admin
-            FROM usuarios
-            WHERE username = %s
-            AND activo = true
-        """, (username,))
+        ejecutar_preparada(cur, "login_usuario", (username,))
 
         user = cur.fetchone()
         cur.close()
@@ -149,18 +1238,17 @@ from datetime import datetime, timedelta
 from flask import request, render_template
 from flask_login import login_required, current_user
 
-@app.route("/")
-@login_required
-def index():
-    db = get_db()
-    cur = db.cursor()
-
-    guardia_filtro = request.args.get("guardia")
-    estado_filtro = request.args.get("estado")
-    resueltos_filtro = request.args.get("resueltos")
-    from_dashboard = request.args.get("from_dashboard")
-    q = request.args.get("q")
-    page = int(request.args.get("page", 1))
+def _filtros_guardias(args):
+    """
+    WHERE de la lista de llamados según los filtros de la query string
+    (guardia, estado, resueltos, q, desde, hasta) y los permisos del usuario.
+    Lo usan index() y la API JSON. Devuelve (where, params, q_norm).
+    """
+    guardia_filtro = args.get("guardia")
+    estado_filtro = args.get("estado")
+    resueltos_filtro = args.get("resueltos")
+    q = args.get("q")
+    q_norm = None
 
     where = []
     params = []
@@ -192,12 +1280,26 @@ def index():
     if resueltos_filtro == "hoy":
         where.append("estado = 'Resuelto'")
         where.append("fecha_resolucion IS NOT NULL")
-        where.append("DATE(fecha_resolucion) = CURRENT_DATE")
+        where.append(f"DATE(fecha_resolucion) = {backend.hoy}")
 
     elif resueltos_filtro == "semana":
         where.append("estado = 'Resuelto'")
         where.append("fecha_resolucion IS NOT NULL")
-        where.append("fecha_resolucion >= date_trunc('week', CURRENT_DATE)")
+        where.append(f"fecha_resolucion >= {backend.inicio_semana}")
+
+    # =========================
+    # RANGO DE FECHAS (fecha del llamado, YYYY-MM-DD inclusive)
+    # =========================
+    try:
+        if args.get("desde"):
+            where.append("fecha_llamado >= %s")
+            params.append(datetime.strptime(args["desde"], "%Y-%m-%d"))
+
+        if args.get("hasta"):
+            where.append("fecha_llamado < %s")
+            params.append(datetime.strptime(args["hasta"], "%Y-%m-%d") + timedelta(days=1))
+    except ValueError:
+        abort(400, description="Fecha inválida (formato AAAA-MM-DD)")
 
     # =========================
     # 🔍 BÚSQUEDA FLEXIBLE
@@ -215,8 +1317,38 @@ def index():
         """)
         params.extend([like, like, like])
 
+    return where, params, q_norm
+
+
+@app.route("/")
+@login_required
+@clase_consulta("interactiva")
+def index():
+    db = get_db()
+    cur = db.cursor()
+
+    guardia_filtro = request.args.get("guardia")
+    estado_filtro = request.args.get("estado")
+    resueltos_filtro = request.args.get("resueltos")
+    from_dashboard = request.args.get("from_dashboard")
+    q = request.args.get("q")
+    page = int(request.args.get("page", 1))
+
+    where, params, q_norm = _filtros_guardias(request.args)
+
     where_sql = "WHERE " + " AND ".join(where) if where else ""
 
+    # =========================
+    # PAGINACIÓN (en la base, no en Python)
+    # =========================
+    ITEMS_PER_PAGE = 10
+    total = contar(cur, f"FROM guardias {where_sql}", params, "estimado")
+    total_pages = (total.valor + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
+
+    # Con conteo aproximado puede haber más páginas de las que se muestran
+    if not total.exacto:
+        total_pages = max(total_pages, page)
+
     query = f"""
         SELECT *
         FROM guardias
@@ -228,20 +1360,11 @@ def index():
                 WHEN 'Baja' THEN 3
             END,
             fecha_llamado DESC
+        LIMIT %s OFFSET %s
     """
 
-    cur.execute(query, params)
-    guardias_all = cur.fetchall()
-
-    # =========================
-    # PAGINACIÓN
-    # =========================
-    ITEMS_PER_PAGE = 10
-    total = len(guardias_all)
-    total_pages = (total + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
-    start = (page - 1) * ITEMS_PER_PAGE
-    end = start + ITEMS_PER_PAGE
-    guardias_pag = guardias_all[start:end]
+    cur.execute(query, params + [ITEMS_PER_PAGE, (page - 1) * ITEMS_PER_PAGE])
+    guardias_pag = cur.fetchall()
 
     # =========================
     # RECIENTES + RESALTADO
@@ -295,12 +1418,15 @@ def index():
         from_dashboard=from_dashboard,
         q=q,
         page=page,
-        total_pages=total_pages
+        total_pages=total_pages,
+        total=total,
+        total_exacto=total.exacto
     )
 
 # ---------- PANEL DE USUARIOS (SOLO ADMIN) ----------
 @app.route("/usuarios")
 @login_required
+@clase_consulta("interactiva")
 def panel_usuarios():
     if not current_user.es_admin:
         abort(403)
@@ -413,6 +1539,7 @@ def editar_usuario(user_id):
 
 @app.route("/usuarios/toggle/<int:user_id>", methods=["POST"])
 @login_required
+@clase_consulta("escritura")
 def toggle_usuario(user_id):
     if not current_user.es_admin:
         return jsonify({"error": "No autorizado"}), 403
@@ -420,9 +1547,17 @@ def toggle_usuario(user_id):
     try:
         db = get_db()
         cur = db.cursor()
-        cur.execute("UPDATE usuarios SET activo = NOT activo WHERE id = %s", (user_id,))
+        cur.execute("UPDATE usuarios SET activo = NOT activo WHERE id = %s RETURNING activo", (user_id,))
+        usuario = cur.fetchone()
         db.commit()
         cur.close()
+
+        if usuario:
+            # bool(): según el motor / la base vieja, activo llega como 0/1
+            activo = bool(usuario["activo"])
+            auditoria.registrar("usuarios", user_id, {
+                "activo": (not activo, activo)
+            })
         return jsonify({"success": True}), 200
     except Exception as e:
         db.rollback()
@@ -431,6 +1566,7 @@ def toggle_usuario(user_id):
 
 @app.route("/usuarios/<int:user_id>/toggle-admin", methods=["POST"])
 @login_required
+@clase_consulta("escritura")
 def toggle_admin(user_id):
     if not current_user.es_admin:
         return jsonify({"error": "No autorizado"}), 403
@@ -442,9 +1578,16 @@ def toggle_admin(user_id):
     try:
         db = get_db()
         cur = db.cursor()
-        cur.execute("UPDATE usuarios SET es_admin = NOT es_admin WHERE id = %s", (user_id,))
+        cur.execute("UPDATE usuarios SET es_admin = NOT es_admin WHERE id = %s RETURNING es_admin", (user_id,))
+        usuario = cur.fetchone()
         db.commit()
         cur.close()
+
+        if usuario:
+            es_admin = bool(usuario["es_admin"])
+            auditoria.registrar("usuarios", user_id, {
+                "es_admin": (not es_admin, es_admin)
+            })
         return jsonify({"success": True}), 200
     except Exception as e:
         db.rollback()
@@ -463,25 +1606,30 @@ def eliminar_usuario(username):
         return redirect("/usuarios")
 
     db = get_db()
+    cur = db.cursor()
 
     # No borrar último admin
-    admins = db.execute(
-        "SELECT COUNT(*) FROM usuarios WHERE es_admin = 1"
-    ).fetchone()[0]
+    cur.execute("SELECT COUNT(*) AS admins FROM usuarios WHERE es_admin = true")
+    admins = cur.fetchone()["admins"]
 
-    usuario = db.execute(
-        "SELECT * FROM usuarios WHERE username = ?",
+    cur.execute(
+        "SELECT * FROM usuarios WHERE username = %s",
         (username,)
-    ).fetchone()
+    )
+    usuario = cur.fetchone()
 
-    if usuario["es_admin"] and admins <= 1:
+    if not usuario or (usuario["es_admin"] and admins <= 1):
+        cur.close()
+        db.close()
         return redirect("/usuarios")
 
-    db.execute(
-        "DELETE FROM usuarios WHERE username = ?",
+    cur.execute(
+        "DELETE FROM usuarios WHERE username = %s",
         (username,)
     )
     db.commit()
+    cur.close()
+    db.close()
 
     return redirect("/usuarios")
 
@@ -495,25 +1643,30 @@ def desactivar_usuario(username):
         return redirect("/usuarios")
 
     db = get_db()
+    cur = db.cursor()
 
     # evitar desactivar último admin
-    admins = db.execute(
-        "SELECT COUNT(*) FROM usuarios WHERE es_admin = 1 AND activo = 1"
-    ).fetchone()[0]
+    cur.execute("SELECT COUNT(*) AS admins FROM usuarios WHERE es_admin = true AND activo = true")
+    admins = cur.fetchone()["admins"]
 
-    usuario = db.execute(
-        "SELECT * FROM usuarios WHERE username = ?",
+    cur.execute(
+        "SELECT * FROM usuarios WHERE username = %s",
         (username,)
-    ).fetchone()
+    )
+    usuario = cur.fetchone()
 
-    if usuario["es_admin"] and admins <= 1:
+    if not usuario or (usuario["es_admin"] and admins <= 1):
+        cur.close()
+        db.close()
         return redirect("/usuarios")
 
-    db.execute(
-        "UPDATE usuarios SET activo = 0 WHERE username = ?",
+    cur.execute(
+        "UPDATE usuarios SET activo = false WHERE username = %s",
         (username,)
     )
     db.commit()
+    cur.close()
+    db.close()
     return redirect("/usuarios")
 
 @app.route("/usuarios/activar/<username>", methods=["POST"])
@@ -523,11 +1676,14 @@ def activar_usuario(username):
         abort(403)
 
     db = get_db()
-    db.execute(
-        "UPDATE usuarios SET activo = 1 WHERE username = ?",
+    cur = db.cursor()
+    cur.execute(
+        "UPDATE usuarios SET activo = true WHERE username = %s",
         (username,)
     )
     db.commit()
+    cur.close()
+    db.close()
     return redirect("/usuarios")
 
 
@@ -559,6 +1715,7 @@ def reset_password(user_id):
 # ================== NUEVA GUARDIA ==================
 @app.route("/nueva", methods=["GET", "POST"])
 @login_required
+@clase_consulta("escritura")
 def nueva_guardia():
     if request.method == "POST":
         db = get_db()
@@ -576,21 +1733,7 @@ def nueva_guardia():
         if estado == "Resuelto":
             fecha_resolucion = datetime.now()
 
-        cur.execute("""
-            INSERT INTO guardias (
-                quien_llamo,
-                fecha_llamado,
-                quien_guardia,
-                descripcion,
-                prioridad,
-                fecha_registro,
-                fecha_resolucion,
-                derivado,
-                derivado_a,
-                estado
-            )
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-        """, (
+        ejecutar_preparada(cur, "guardia_insertar", (
             request.form["quien_llamo"],
             fecha_llamado,
             current_user.username,
@@ -602,9 +1745,24 @@ def nueva_guardia():
             request.form.get("derivado_a"),
             estado
         ))
+        guardia_id = cur.fetchone()["id"]
+
+        invalidar_resumen(cur, fecha_llamado)
+
+        actualizar_rollup(cur, None, {
+            "estado": estado,
+            "fecha_llamado": fecha_llamado,
+            "fecha_resolucion": fecha_resolucion,
+            "quien_guardia": current_user.username,
+            "prioridad": request.form["prioridad"]
+        })
+
+        if request.form["prioridad"] == "Alta" and estado in ESTADOS_SIN_RESOLVER:
+            notificar_sla(cur, guardia_id)
 
         db.commit()
         db.close()
+        invalidar_cache_guardias()
         return redirect("/")
 
     return render_template("nueva_guardia.html")
@@ -612,6 +1770,7 @@ def nueva_guardia():
 
 @app.route("/guardias/editar/<int:guardia_id>", methods=["GET", "POST"])
 @login_required
+@clase_consulta("escritura")
 def editar_guardia(guardia_id):
     db = get_db()
     cur = db.cursor()
@@ -623,6 +1782,17 @@ def editar_guardia(guardia_id):
         derivado = "derivado" in request.form
         derivado_a = request.form.get("derivado_a")
 
+        # Bloqueada hasta el commit: dos ediciones simultáneas no pueden
+        # partir de la misma fila vieja (el rollup sumaría dos veces)
+        cur.execute(f"""
+            SELECT estado, descripcion, resolucion, derivado_a,
+                   fecha_llamado, fecha_resolucion, quien_guardia, prioridad
+            FROM guardias
+            WHERE id = %s
+            {backend.para_actualizar(cur)}
+        """, (guardia_id,))
+        anterior = cur.fetchone()
+
         cur.execute("""
             UPDATE guardias
             SET estado = %s,
@@ -631,6 +1801,7 @@ def editar_guardia(guardia_id):
                 derivado = %s,
                 derivado_a = %s
             WHERE id = %s
+            RETURNING estado, fecha_llamado, fecha_resolucion, quien_guardia, prioridad
         """, (
             estado,
             descripcion,
@@ -639,8 +1810,25 @@ def editar_guardia(guardia_id):
             derivado_a,
             guardia_id
         ))
+        actualizado = cur.fetchone()
+
+        actualizar_rollup(cur, anterior, actualizado)
+        if anterior:
+            invalidar_resumen(cur, anterior["fecha_llamado"])
+
+        if actualizado and actualizado["prioridad"] == "Alta":
+            notificar_sla(cur, guardia_id)
 
         db.commit()
+        invalidar_cache_guardias()
+
+        if anterior:
+            auditoria.registrar("guardias", guardia_id, {
+                "estado": (anterior["estado"], estado),
+                "descripcion": (anterior["descripcion"], descripcion),
+                "resolucion": (anterior["resolucion"], resolucion),
+                "derivado_a": (anterior["derivado_a"], derivado_a)
+            })
         cur.close()
         flash("Llamado actualizado correctamente", "success")
         return redirect(url_for("index"))
@@ -654,6 +1842,8 @@ def editar_guardia(guardia_id):
 
 @app.route("/historial_guardias")
 @login_required
+@cache_fragmento(condicion=lambda: request.args.get("page", 1, type=int) == 1)
+@clase_consulta("interactiva")
 def historial_guardias():
     import math
 
@@ -690,9 +1880,8 @@ def historial_guardias():
 
         where = f"WHERE {' AND '.join(filtros)}" if filtros else ""
 
-        # TOTAL
-        cur.execute(f"SELECT COUNT(*) FROM guardias {where}", params)
-        total = cur.fetchone()[0]
+        # TOTAL (exacto hasta CONTEO_UMBRAL, después estimado)
+        total = contar(cur, f"FROM guardias {where}", params, "estimado")
 
         # DATOS
         cur.execute(f"""
@@ -707,28 +1896,18 @@ def historial_guardias():
     # GUARDIA NORMAL (paginación desde 11)
     # ===============================
     else:
-        cur.execute("""
-            SELECT COUNT(*)
-            FROM guardias
-            WHERE quien_guardia = %s
-        """, (current_user.username,))
-        total = cur.fetchone()[0]
+        # Conteo con tope (como contar(..., "tope")), preparado
+        ejecutar_preparada(cur, "historial_propio_contar", (current_user.username, CONTEO_UMBRAL + 1))
+        total = Conteo.con_tope(cur.fetchone()["total"], CONTEO_UMBRAL)
 
-        if total <= 10:
-            cur.execute("""
-                SELECT *
-                FROM guardias
-                WHERE quien_guardia = %s
-                ORDER BY fecha_registro DESC
-            """, (current_user.username,))
+        if total.valor <= 10:
+            ejecutar_preparada(cur, "historial_propio_todo", (current_user.username,))
         else:
-            cur.execute("""
-                SELECT *
-                FROM guardias
-                WHERE quien_guardia = %s
-                ORDER BY fecha_registro DESC
-                LIMIT %s OFFSET %s
-            """, (current_user.username, per_page, offset))
+            ejecutar_preparada(
+                cur,
+                "historial_propio_pagina",
+                (current_user.username, per_page, offset)
+            )
 
     guardias = cur.fetchall()
     cur.close()
@@ -737,9 +1916,13 @@ def historial_guardias():
     # TOTAL PAGES (CLAVE DEL ARREGLO)
     # ===============================
     if current_user.es_admin:
-        total_pages = math.ceil(total / per_page)
+        total_pages = math.ceil(total.valor / per_page)
     else:
-        total_pages = math.ceil(total / per_page) if total > 10 else 1
+        total_pages = math.ceil(total.valor / per_page) if total.valor > 10 else 1
+
+    # Con conteo aproximado puede haber más páginas de las que se muestran
+    if not total.exacto:
+        total_pages = max(total_pages, page)
 
     return render_template(
         "historial_guardias.html",
@@ -748,7 +1931,8 @@ def historial_guardias():
         guardia_filtro=guardia_filtro,
         page=page,
         total_pages=total_pages,
-        total=total
+        total=total,
+        total_exacto=total.exacto
     )
 
 
@@ -762,6 +1946,8 @@ def historial_guardias():
 # ================== DASHBOARD ==================
 @app.route("/dashboard")
 @login_required
+@cache_fragmento()
+@clase_consulta("dashboard")
 def dashboard():
     if not current_user.es_admin:
         return redirect("/")
@@ -784,45 +1970,22 @@ def dashboard():
     where_sql = "WHERE " + " AND ".join(where) if where else ""
 
     # ======================
-    # TOTAL GENERAL
+    # CONTADORES (exactos, cacheados y refrescados en segundo plano)
     # ======================
-    cur.execute(f"""
-        SELECT COUNT(*) FROM guardias
-        {where_sql}
-    """, params)
-    total = cur.fetchone()["count"]
+    y = "AND" if where_sql else "WHERE"
 
-    # ======================
-    # ABIERTOS
-    # ======================
-    cur.execute(f"""
-        SELECT COUNT(*) FROM guardias
-        {where_sql} {"AND" if where_sql else "WHERE"} estado = 'Abierto'
-    """, params)
-    abiertos = cur.fetchone()["count"]
+    total = contar(cur, f"FROM guardias {where_sql}", params, "cache").valor
+    abiertos = contar(cur, f"FROM guardias {where_sql} {y} estado = 'Abierto'", params, "cache").valor
+    en_progreso = contar(cur, f"FROM guardias {where_sql} {y} estado = 'En progreso'", params, "cache").valor
+    total_resueltos = contar(cur, f"""
+        FROM guardias
+        {where_sql} {y}
+        estado = 'Resuelto'
+        AND fecha_resolucion IS NOT NULL
+    """, params, "cache").valor
 
     # ======================
-    # EN PROGRESO
-    # ======================
-    cur.execute(f"""
-        SELECT COUNT(*) FROM guardias
-        {where_sql} {"AND" if where_sql else "WHERE"} estado = 'En progreso'
-    """, params)
-    en_progreso = cur.fetchone()["count"]
-
-    # ======================
-    # RESUELTOS
-    # ======================
-    cur.execute(f"""
-        SELECT COUNT(*) FROM guardias
-        {where_sql} {"AND" if where_sql else "WHERE"}
-        estado = 'Resuelto'
-        AND fecha_resolucion IS NOT NULL
-    """, params)
-    total_resueltos = cur.fetchone()["count"]
-
-    # ======================
-    # TOP GUARDIAS (solo sin filtro)
+    # TOP GUARDIAS (solo sin filtro)
     # ======================
     top_guardias = []
     if not guardia_filtro:
@@ -841,7 +2004,7 @@ def dashboard():
     # ======================
     cur.execute(f"""
         SELECT AVG(
-            EXTRACT(EPOCH FROM (fecha_resolucion - fecha_llamado)) / 60
+            {backend.minutos_entre("fecha_llamado", "fecha_resolucion")}
         ) AS promedio
         FROM guardias
         {where_sql} {"AND" if where_sql else "WHERE"}
@@ -880,16 +2043,14 @@ def dashboard():
 
 @app.route("/resolver_guardia/<int:id>", methods=["POST"])
 @login_required
+@clase_consulta("escritura")
 def resolver_guardia(id):
     db = get_db()
     cur = db.cursor()
 
-    # Solo admin o el guardia asignado pueden resolver
-    cur.execute("""
-        SELECT quien_guardia
-        FROM guardias
-        WHERE id = %s
-    """, (id,))
+    # Solo admin o el guardia asignado pueden resolver. La fila queda
+    # bloqueada hasta el commit (ver actualizar_rollup)
+    ejecutar_preparada(cur, "guardia_para_resolver", (id,))
     guardia = cur.fetchone()
 
     if not guardia:
@@ -901,31 +2062,41 @@ def resolver_guardia(id):
         return redirect("/historial_guardias")
 
     # Marcar como resuelto + fecha
-    cur.execute("""
-        UPDATE guardias
-        SET estado = 'Resuelto',
-            fecha_resolucion = NOW()
-        WHERE id = %s
-    """, (id,))
+    ejecutar_preparada(cur, "guardia_resolver", (id,))
+
+    actualizar_rollup(cur, guardia, cur.fetchone())
+    invalidar_resumen(cur, guardia["fecha_llamado"])
+
+    if guardia["prioridad"] == "Alta":
+        notificar_sla(cur, id)
 
     db.commit()
     cur.close()
+    invalidar_cache_guardias()
 
     return redirect("/historial_guardias")
 
 import csv
 import io
-from flask import Response
-
-@app.route("/reporte/guardias")
-@login_required
-def reporte_guardias():
-
-    db = get_db()
-    cur = db.cursor()
-
-    guardia = request.args.get("guardia")
-
+import gzip
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response, send_file
+
+ENCABEZADOS_REPORTE = [
+    "Fecha llamado",
+    "Fecha carga",
+    "Quién llamó",
+    "Guardia",
+    "Prioridad",
+    "Descripción",
+    "Estado",
+    "Fecha resolución"
+]
+
+
+def _consulta_reporte(guardia):
     where = ""
     params = []
 
@@ -933,7 +2104,7 @@ def reporte_guardias():
         where = "WHERE quien_guardia = %s"
         params.append(guardia)
 
-    cur.execute(f"""
+    query = f"""
         SELECT
             fecha_llamado,
             fecha_registro,
@@ -946,7 +2117,35 @@ def reporte_guardias():
         FROM guardias
         {where}
         ORDER BY fecha_llamado DESC
-    """, params)
+    """
+    return query, params
+
+
+def _fila_reporte(r):
+    return [
+        r["fecha_llamado"],
+        r["fecha_registro"],
+        r["quien_llamo"],
+        r["quien_guardia"],
+        r["prioridad"],
+        r["descripcion"],
+        r["estado"],
+        r["fecha_resolucion"]
+    ]
+
+
+@app.route("/reporte/guardias")
+@login_required
+@clase_consulta("export")
+def reporte_guardias():
+
+    db = get_db()
+    cur = db.cursor()
+
+    guardia = request.args.get("guardia")
+
+    query, params = _consulta_reporte(guardia)
+    cur.execute(query, params)
 
     rows = cur.fetchall()
 
@@ -954,28 +2153,10 @@ def reporte_guardias():
     output.write("\ufeff")  # 🔥 CLAVE PARA EXCEL
 
     writer = csv.writer(output)
-    writer.writerow([
-        "Fecha llamado",
-        "Fecha carga",
-        "Quién llamó",
-        "Guardia",
-        "Prioridad",
-        "Descripción",
-        "Estado",
-        "Fecha resolución"
-    ])
+    writer.writerow(ENCABEZADOS_REPORTE)
 
     for r in rows:
-        writer.writerow([
-            r["fecha_llamado"],
-            r["fecha_registro"],
-            r["quien_llamo"],
-            r["quien_guardia"],
-            r["prioridad"],
-            r["descripcion"],
-            r["estado"],
-            r["fecha_resolucion"]
-        ])
+        writer.writerow(_fila_reporte(r))
 
     cur.close()
 
@@ -988,6 +2169,2119 @@ def reporte_guardias():
     )
 
 
+# ================== ESQUEMA AUXILIAR ==================
+import click
+
+# Tablas que agregan los módulos nuevos (jobs, etc). Las crea `flask init-db`
+# (CREATE ... IF NOT EXISTS, se puede correr en cada deploy); la app no corre
+# DDL por su cuenta.
+# Las tablas base van primero para poder arrancar con una base SQLite vacía.
+ESQUEMA_EXTRA = ["""
+    CREATE TABLE IF NOT EXISTS usuarios (
+        id SERIAL PRIMARY KEY,
+        username TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        password_hash TEXT,
+        es_admin BOOLEAN NOT NULL DEFAULT false,
+        activo BOOLEAN NOT NULL DEFAULT true,
+        debe_cambiar_password BOOLEAN NOT NULL DEFAULT false
+    )
+""", """
+    CREATE TABLE IF NOT EXISTS guardias (
+        id SERIAL PRIMARY KEY,
+        quien_llamo TEXT NOT NULL,
+        fecha_llamado TIMESTAMP NOT NULL,
+        quien_guardia TEXT NOT NULL,
+        descripcion TEXT,
+        prioridad TEXT DEFAULT 'Media',
+        fecha_registro TIMESTAMP NOT NULL,
+        fecha_resolucion TIMESTAMP,
+        derivado BOOLEAN DEFAULT false,
+        derivado_a TEXT,
+        estado TEXT DEFAULT 'Abierto',
+        resolucion TEXT
+    )
+""", """
+    ALTER TABLE usuarios ADD COLUMN IF NOT EXISTS password_hash TEXT
+""", """
+    ALTER TABLE usuarios ADD COLUMN IF NOT EXISTS debe_cambiar_password BOOLEAN DEFAULT false
+"""]
+
+# Cargas de datos que dependen de tablas recién creadas: fn(cur), después del DDL
+DATOS_INICIALES = []
+
+_esquema_listo = False
+_esquema_lock = threading.Lock()
+
+
+def asegurar_esquema():
+    global _esquema_listo
+
+    if _esquema_listo:
+        return
+
+    with _esquema_lock:
+        if _esquema_listo:
+            return
+
+        db = get_db("export")
+        cur = db.cursor()
+        for ddl in backend.esquema + ESQUEMA_EXTRA:
+            backend.ddl(cur, ddl)
+        for cargar in DATOS_INICIALES:
+            cargar(cur)
+        db.commit()
+        cur.close()
+        db.close()
+
+        _esquema_listo = True
+
+
+@app.cli.command("init-db")
+@click.option(
+    "--migrar-passwords",
+    is_flag=True,
+    help="Copiar a password_hash los hashes viejos guardados en password"
+)
+def init_db(migrar_passwords):
+    """
+    Crea las tablas e índices que falten. Se corre a mano en cada deploy que
+    agregue esquema (la app no toca el esquema al arrancar).
+    """
+    asegurar_esquema()
+    click.echo(f"Esquema listo ({backend.nombre})")
+
+    if not migrar_passwords:
+        return
+
+    # Habilita el login de usuarios viejos: solo a pedido y con el detalle
+    db = get_db("export")
+    cur = db.cursor()
+    cur.execute("""
+        UPDATE usuarios
+        SET password_hash = password
+        WHERE password_hash IS NULL
+        AND password LIKE '%$%'
+        RETURNING username
+    """)
+    migrados = [u["username"] for u in cur.fetchall()]
+    db.commit()
+    cur.close()
+    db.close()
+
+    click.echo(f"Passwords migradas: {len(migrados)}")
+    for username in migrados:
+        click.echo(f"  - {username}")
+
+
+@app.cli.command("crear-usuario")
+@click.argument("username")
+@click.option("--admin", is_flag=True, help="Crear con rol de administrador")
+@click.password_option()
+def crear_usuario(username, admin, password):
+    """Crea un usuario activo (por ejemplo el primer admin). Requiere flask init-db."""
+    db = get_db()
+    cur = db.cursor()
+    cur.execute("""
+        INSERT INTO usuarios (
+            username,
+            password,
+            password_hash,
+            es_admin,
+            activo,
+            debe_cambiar_password
+        )
+        VALUES (%s, %s, %s, %s, true, false)
+    """, (username, "TEMP", generate_password_hash(password), admin))
+    db.commit()
+    cur.close()
+    db.close()
+    click.echo(f"Usuario {username} creado")
+
+
+# ================== REPORTES EN SEGUNDO PLANO ==================
+# Los CSV grandes se arman en un pool de threads propio (no en el worker que
+# atiende el request), se guardan comprimidos en disco y el usuario consulta
+# el estado del job hasta que puede descargarlo.
+REPORTES_DIR = os.environ.get("REPORTES_DIR", os.path.join(app.root_path, "reportes"))
+REPORTES_MAX_CONCURRENTES = int(os.environ.get("REPORTES_MAX_CONCURRENTES", 2))
+REPORTES_MAX_EN_COLA = int(os.environ.get("REPORTES_MAX_EN_COLA", 8))
+REPORTES_MAX_PENDIENTES_POR_USUARIO = int(os.environ.get("REPORTES_MAX_PENDIENTES_POR_USUARIO", 2))
+REPORTES_JOB_VENCIDO_MIN = int(os.environ.get("REPORTES_JOB_VENCIDO_MIN", 60))
+REPORTES_RETENCION_HORAS = int(os.environ.get("REPORTES_RETENCION_HORAS", 24))
+REPORTES_ESPERA_SEG = 2
+REPORTES_ITERSIZE = 2000
+REPORTES_LOCK_ID = 424243
+
+ESQUEMA_EXTRA.append("""
+    CREATE TABLE IF NOT EXISTS reporte_jobs (
+        id SERIAL PRIMARY KEY,
+        usuario TEXT NOT NULL,
+        parametros TEXT,
+        estado TEXT NOT NULL DEFAULT 'pendiente',
+        archivo TEXT,
+        filas INTEGER,
+        error TEXT,
+        fecha_creado TIMESTAMP NOT NULL DEFAULT NOW(),
+        fecha_inicio TIMESTAMP,
+        fecha_fin TIMESTAMP
+    )
+""")
+ESQUEMA_EXTRA.append("""
+    CREATE INDEX IF NOT EXISTS idx_reporte_jobs_pendientes
+    ON reporte_jobs (usuario)
+    WHERE estado IN ('pendiente', 'en_proceso')
+""")
+
+# Los cupos (corriendo / en cola) se cuentan en reporte_jobs, así valen para
+# todos los workers juntos. El pool de cada proceso solo pone los threads.
+_reportes_pool = ThreadPoolExecutor(
+    max_workers=REPORTES_MAX_CONCURRENTES,
+    thread_name_prefix="reporte"
+)
+
+
+def _tomar_turno_reporte(db, cur, job_id):
+    """
+    Pasa el job a en_proceso cuando hay menos de REPORTES_MAX_CONCURRENTES
+    corriendo entre todos los workers; mientras tanto espera. False si el
+    job dejó de estar pendiente (se marcó abandonado).
+    """
+    while True:
+        backend.bloquear(cur, REPORTES_LOCK_ID)
+        cur.execute("SELECT COUNT(*) AS corriendo FROM reporte_jobs WHERE estado = 'en_proceso'")
+
+        if cur.fetchone()["corriendo"] < REPORTES_MAX_CONCURRENTES:
+            cur.execute("""
+                UPDATE reporte_jobs
+                SET estado = 'en_proceso',
+                    fecha_inicio = NOW()
+                WHERE id = %s
+                AND estado = 'pendiente'
+            """, (job_id,))
+            tomado = cur.rowcount == 1
+            db.commit()
+            return tomado
+
+        db.commit()
+        time.sleep(REPORTES_ESPERA_SEG)
+
+
+def _limpiar_reportes_viejos(cur):
+    """Borra jobs terminados hace más de REPORTES_RETENCION_HORAS y sus archivos."""
+    cur.execute("""
+        SELECT id, archivo
+        FROM reporte_jobs
+        WHERE estado IN ('listo', 'error')
+        AND fecha_fin < %s
+    """, (datetime.now() - timedelta(hours=REPORTES_RETENCION_HORAS),))
+    viejos = cur.fetchall()
+
+    for job in viejos:
+        if job["archivo"] and os.path.exists(job["archivo"]):
+            os.remove(job["archivo"])
+        cur.execute("DELETE FROM reporte_jobs WHERE id = %s", (job["id"],))
+
+
+def _generar_reporte(job_id, guardia):
+    db = get_db("export")
+    cur = db.cursor()
+    archivo = os.path.join(REPORTES_DIR, f"guardias_{job_id}.csv.gz")
+    tmp = archivo + ".tmp"
+
+    try:
+        if not _tomar_turno_reporte(db, cur, job_id):
+            return
+
+        os.makedirs(REPORTES_DIR, exist_ok=True)
+
+        # Cursor del lado del servidor: se trae de a REPORTES_ITERSIZE filas
+        # en lugar de cargar toda la tabla en memoria
+        query, params = _consulta_reporte(guardia)
+        stream = db.cursor(name=f"reporte_{job_id}")
+        stream.itersize = REPORTES_ITERSIZE
+        stream.execute(query, params)
+
+        filas = 0
+        # utf-8-sig agrega el BOM, igual que el export directo (Excel)
+        with gzip.open(tmp, "wt", encoding="utf-8-sig", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(ENCABEZADOS_REPORTE)
+            for r in stream:
+                writer.writerow(_fila_reporte(r))
+                filas += 1
+
+        stream.close()
+        os.replace(tmp, archivo)
+
+        cur.execute("""
+            UPDATE reporte_jobs
+            SET estado = 'listo',
+                archivo = %s,
+                filas = %s,
+                fecha_fin = NOW()
+            WHERE id = %s
+        """, (archivo, filas, job_id))
+        db.commit()
+
+    except Exception as e:
+        db.rollback()
+        app.logger.exception("Error generando reporte %s", job_id)
+
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+        cur.execute("""
+            UPDATE reporte_jobs
+            SET estado = 'error',
+                error = %s,
+                fecha_fin = NOW()
+            WHERE id = %s
+        """, (str(e), job_id))
+        db.commit()
+
+    finally:
+        cur.close()
+        db.close()
+
+
+def _job_visible(job):
+    return job and (current_user.es_admin or job["usuario"] == current_user.username)
+
+
+@app.route("/reporte/guardias/async", methods=["POST"])
+@login_required
+def reporte_guardias_async():
+    guardia = request.values.get("guardia")
+
+    # Un guardia común solo puede exportar sus propios llamados
+    if not current_user.es_admin:
+        guardia = current_user.username
+
+    db = get_db()
+    cur = db.cursor()
+
+    _limpiar_reportes_viejos(cur)
+
+    # Jobs que quedaron colgados (worker reiniciado, etc) se marcan como error
+    cur.execute("""
+        UPDATE reporte_jobs
+        SET estado = 'error',
+            error = 'Job abandonado',
+            fecha_fin = NOW()
+        WHERE estado IN ('pendiente', 'en_proceso')
+        AND fecha_creado < %s
+    """, (datetime.now() - timedelta(minutes=REPORTES_JOB_VENCIDO_MIN),))
+
+    cur.execute("""
+        SELECT COUNT(*) AS pendientes
+        FROM reporte_jobs
+        WHERE usuario = %s
+        AND estado IN ('pendiente', 'en_proceso')
+    """, (current_user.username,))
+
+    if cur.fetchone()["pendientes"] >= REPORTES_MAX_PENDIENTES_POR_USUARIO:
+        db.commit()
+        cur.close()
+        db.close()
+        return jsonify({"error": "Ya tenés reportes en proceso, esperá a que terminen"}), 429
+
+    db.commit()
+
+    # Cupo total entre todos los workers (corriendo + en cola)
+    backend.bloquear(cur, REPORTES_LOCK_ID)
+    cur.execute("""
+        SELECT COUNT(*) AS activos
+        FROM reporte_jobs
+        WHERE estado IN ('pendiente', 'en_proceso')
+    """)
+
+    if cur.fetchone()["activos"] >= REPORTES_MAX_CONCURRENTES + REPORTES_MAX_EN_COLA:
+        db.commit()
+        cur.close()
+        db.close()
+        return jsonify({"error": "Hay demasiados reportes en cola, probá en unos minutos"}), 503
+
+    try:
+        cur.execute("""
+            INSERT INTO reporte_jobs (usuario, parametros)
+            VALUES (%s, %s)
+            RETURNING id
+        """, (current_user.username, json.dumps({"guardia": guardia})))
+        job_id = cur.fetchone()["id"]
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+        db.close()
+
+    _reportes_pool.submit(_generar_reporte, job_id, guardia)
+
+    return jsonify({
+        "job_id": job_id,
+        "estado": "pendiente",
+        "estado_url": url_for("reporte_job_estado", job_id=job_id),
+        "descarga_url": url_for("reporte_job_descargar", job_id=job_id)
+    }), 202
+
+
+@app.route("/reporte/jobs/<int:job_id>")
+@login_required
+def reporte_job_estado(job_id):
+    db = get_db()
+    cur = db.cursor()
+    cur.execute("""
+        SELECT id, usuario, parametros, estado, filas, error,
+               fecha_creado, fecha_inicio, fecha_fin
+        FROM reporte_jobs
+        WHERE id = %s
+    """, (job_id,))
+    job = cur.fetchone()
+    cur.close()
+    db.close()
+
+    if not _job_visible(job):
+        abort(404)
+
+    return jsonify({
+        "job_id": job["id"],
+        "estado": job["estado"],
+        "parametros": json.loads(job["parametros"] or "{}"),
+        "filas": job["filas"],
+        "error": job["error"],
+        "fecha_creado": job["fecha_creado"].isoformat() if job["fecha_creado"] else None,
+        "fecha_inicio": job["fecha_inicio"].isoformat() if job["fecha_inicio"] else None,
+        "fecha_fin": job["fecha_fin"].isoformat() if job["fecha_fin"] else None,
+        "descarga_url": url_for("reporte_job_descargar", job_id=job_id) if job["estado"] == "listo" else None
+    })
+
+
+@app.route("/reporte/jobs/<int:job_id>/descargar")
+@login_required
+def reporte_job_descargar(job_id):
+    db = get_db()
+    cur = db.cursor()
+    cur.execute("""
+        SELECT usuario, estado, archivo
+        FROM reporte_jobs
+        WHERE id = %s
+    """, (job_id,))
+    job = cur.fetchone()
+    cur.close()
+    db.close()
+
+    if not _job_visible(job):
+        abort(404)
+
+    if job["estado"] != "listo" or not job["archivo"] or not os.path.exists(job["archivo"]):
+        return jsonify({"error": "El reporte todavía no está listo"}), 409
+
+    return send_file(
+        job["archivo"],
+        mimetype="application/gzip",
+        as_attachment=True,
+        download_name=f"guardias_{job_id}.csv.gz"
+    )
+
+
+# ================== ESCALAMIENTO SLA ==================
+# Los llamados 'Alta' que siguen Abierto / En progreso después de
+# SLA_ALTA_MINUTOS se marcan (fecha_escalado) y se escalan.
+#
+# No se recorre la tabla periódicamente: cada worker tiene un thread, pero
+# solo el que consigue el advisory lock (el líder) trabaja. El líder arma un
+# heap con los vencimientos pendientes (leídos del índice parcial) y duerme
+# hasta el próximo vencimiento o hasta que llega un aviso (NOTIFY en Postgres)
+# de las rutas que modifican guardias.
+import heapq
+import urllib.request
+
+SLA_ALTA_MINUTOS = int(os.environ.get("SLA_ALTA_MINUTOS", 30))
+ESCALAMIENTO_ACTIVO = os.environ.get("ESCALAMIENTO_ACTIVO", "1") == "1"
+ESCALAMIENTO_WEBHOOK_URL = os.environ.get("ESCALAMIENTO_WEBHOOK_URL")
+ESCALAMIENTO_REINTENTO_SEG = 30
+ESCALAMIENTO_LOCK_ID = 7_270_001
+ESCALAMIENTO_CANAL = "guardias_sla"
+
+ESTADOS_SIN_RESOLVER = ("Abierto", "En progreso")
+
+ESQUEMA_EXTRA.append("""
+    ALTER TABLE guardias ADD COLUMN IF NOT EXISTS fecha_escalado TIMESTAMP
+""")
+ESQUEMA_EXTRA.append("""
+    CREATE INDEX IF NOT EXISTS idx_guardias_alta_sin_resolver
+    ON guardias (fecha_llamado)
+    WHERE prioridad = 'Alta'
+    AND estado IN ('Abierto', 'En progreso')
+    AND fecha_escalado IS NULL
+""")
+
+
+def notificar_sla(cur, guardia_id):
+    """Avisa al líder que un llamado cambió. Se entrega recién en el commit."""
+    if not ESCALAMIENTO_ACTIVO:
+        return
+    backend.notificar(cur, ESCALAMIENTO_CANAL, str(guardia_id))
+
+
+class EscaladorSLA:
+    def __init__(self):
+        self.heap = []        # (vencimiento, guardia_id)
+        self.vigentes = {}    # guardia_id -> vencimiento (para descartar entradas viejas del heap)
+        self.iniciado = False
+        self.lock = threading.Lock()
+
+    def iniciar(self):
+        with self.lock:
+            if self.iniciado:
+                return
+            self.iniciado = True
+
+        threading.Thread(target=self._correr, name="escalador-sla", daemon=True).start()
+
+    # ---------- HEAP ----------
+    def _programar(self, guardia_id, fecha_llamado):
+        vencimiento = fecha_llamado + timedelta(minutes=SLA_ALTA_MINUTOS)
+        self.vigentes[guardia_id] = vencimiento
+        heapq.heappush(self.heap, (vencimiento, guardia_id))
+
+    def _descartar(self, guardia_id):
+        # El heap se limpia solo: la entrada queda huérfana y se ignora al salir
+        self.vigentes.pop(guardia_id, None)
+
+    def _reconstruir(self, cur):
+        self.heap = []
+        self.vigentes = {}
+
+        cur.execute("""
+            SELECT id, fecha_llamado
+            FROM guardias
+            WHERE prioridad = 'Alta'
+            AND estado IN ('Abierto', 'En progreso')
+            AND fecha_escalado IS NULL
+        """)
+        for row in cur.fetchall():
+            self._programar(row["id"], row["fecha_llamado"])
+
+    def _refrescar(self, cur, guardia_id):
+        cur.execute("""
+            SELECT id, fecha_llamado, prioridad, estado, fecha_escalado
+            FROM guardias
+            WHERE id = %s
+        """, (guardia_id,))
+        row = cur.fetchone()
+
+        if (
+            row
+            and row["prioridad"] == "Alta"
+            and row["estado"] in ESTADOS_SIN_RESOLVER
+            and row["fecha_escalado"] is None
+        ):
+            self._programar(row["id"], row["fecha_llamado"])
+        else:
+            self._descartar(guardia_id)
+
+    # ---------- DISPARO ----------
+    def _disparar_vencidos(self, cur):
+        ahora = datetime.now()
+
+        while self.heap and self.heap[0][0] <= ahora:
+            vencimiento, guardia_id = heapq.heappop(self.heap)
+
+            if self.vigentes.get(guardia_id) != vencimiento:
+                continue
+            del self.vigentes[guardia_id]
+
+            # La condición se vuelve a chequear en el UPDATE por si otro
+            # proceso lo resolvió justo antes
+            cur.execute("""
+                UPDATE guardias
+                SET fecha_escalado = NOW()
+                WHERE id = %s
+                AND prioridad = 'Alta'
+                AND estado IN ('Abierto', 'En progreso')
+                AND fecha_escalado IS NULL
+                RETURNING id, quien_llamo, quien_guardia, descripcion, estado, fecha_llamado
+            """, (guardia_id,))
+            row = cur.fetchone()
+
+            if row:
+                self._escalar(row)
+
+    def _escalar(self, row):
+        app.logger.warning(
+            "SLA vencido: llamado %s (%s) de %s, guardia %s, sigue %s",
+            row["id"], row["descripcion"], row["quien_llamo"],
+            row["quien_guardia"], row["estado"]
+        )
+
+        if not ESCALAMIENTO_WEBHOOK_URL:
+            return
+
+        payload = json.dumps({
+            "id": row["id"],
+            "quien_llamo": row["quien_llamo"],
+            "quien_guardia": row["quien_guardia"],
+            "descripcion": row["descripcion"],
+            "estado": row["estado"],
+            "fecha_llamado": row["fecha_llamado"].isoformat(),
+            "sla_minutos": SLA_ALTA_MINUTOS
+        }).encode("utf-8")
+
+        try:
+            req = urllib.request.Request(
+                ESCALAMIENTO_WEBHOOK_URL,
+                data=payload,
+                headers={"Content-Type": "application/json"}
+            )
+            urllib.request.urlopen(req, timeout=5).close()
+        except Exception:
+            app.logger.exception("No se pudo avisar el escalamiento del llamado %s", row["id"])
+
+    # ---------- LOOP ----------
+    def _correr(self):
+        while True:
+            db = None
+            try:
+                # Conexión propia (fuera del pool): LISTEN y el advisory lock
+                # son de la sesión
+                db = get_db(dedicada=True)
+                db.autocommit = True
+                cur = db.cursor()
+
+                # Un solo líder entre todos los workers de gunicorn. El lock
+                # se libera solo si se cae la conexión / el proceso.
+                if not backend.tomar_liderazgo(db, cur, ESCALAMIENTO_LOCK_ID):
+                    db.close()
+                    time.sleep(ESCALAMIENTO_REINTENTO_SEG)
+                    continue
+
+                backend.escuchar(db, cur, ESCALAMIENTO_CANAL)
+                self._reconstruir(cur)
+                self._escuchar(db, cur)
+
+            except Exception:
+                app.logger.exception("Escalador SLA: error, se reintenta")
+                time.sleep(ESCALAMIENTO_REINTENTO_SEG)
+
+            finally:
+                if db is not None and not db.closed:
+                    db.close()
+
+    def _escuchar(self, db, cur):
+        while True:
+            self._disparar_vencidos(cur)
+
+            if self.heap:
+                espera = (self.heap[0][0] - datetime.now()).total_seconds()
+                espera = min(max(espera, 0), 300)
+            else:
+                espera = 300
+
+            # Duerme hasta el próximo vencimiento o hasta un aviso
+            for payload in backend.esperar_avisos(db, cur, ESCALAMIENTO_CANAL, espera):
+                self._refrescar(cur, int(payload))
+
+
+escalador_sla = EscaladorSLA()
+
+
+@app.before_request
+def _iniciar_procesos_fondo():
+    # El esquema (tablas auxiliares, índices) lo crea `flask init-db`, nunca
+    # un request: acá solo se arranca el escalador
+    if not DATABASE_URL:
+        return
+
+    if ESCALAMIENTO_ACTIVO and not escalador_sla.iniciado:
+        escalador_sla.iniciar()
+
+
+# ================== AUDITORÍA ==================
+# Quién cambió qué en guardias / usuarios. Los eventos se encolan en memoria
+# y un thread los graba por lotes (un solo INSERT multi-fila), así el request
+# no paga un INSERT extra por cada campo modificado.
+import atexit
+import queue
+
+AUDITORIA_BUFFER = int(os.environ.get("AUDITORIA_BUFFER", 1000))
+AUDITORIA_LOTE = int(os.environ.get("AUDITORIA_LOTE", 200))
+AUDITORIA_INTERVALO_SEG = float(os.environ.get("AUDITORIA_INTERVALO_SEG", 2))
+
+ESQUEMA_EXTRA.append("""
+    CREATE TABLE IF NOT EXISTS auditoria (
+        id SERIAL PRIMARY KEY,
+        fecha TIMESTAMP NOT NULL,
+        usuario TEXT,
+        entidad TEXT NOT NULL,
+        entidad_id INTEGER NOT NULL,
+        campo TEXT NOT NULL,
+        valor_anterior TEXT,
+        valor_nuevo TEXT
+    )
+""")
+ESQUEMA_EXTRA.append("""
+    CREATE INDEX IF NOT EXISTS idx_auditoria_entidad
+    ON auditoria (entidad, entidad_id, fecha)
+""")
+
+
+def _valor_auditoria(valor):
+    # Los formularios mandan "" para un campo vacío y la base tiene NULL:
+    # son el mismo valor, no un cambio
+    return None if valor is None or valor == "" else str(valor)
+
+
+class Auditoria:
+    def __init__(self):
+        self.cola = queue.Queue(maxsize=AUDITORIA_BUFFER)
+        self.iniciado = False
+        self.lock = threading.Lock()
+        self.grabando = threading.Lock()
+        # Lote que ya salió de la cola pero no se pudo grabar: va primero
+        self.fallido = []
+
+    def registrar(self, entidad, entidad_id, cambios):
+        """cambios: {campo: (valor_anterior, valor_nuevo)}. Solo se encolan los distintos."""
+        usuario = current_user.username if current_user.is_authenticated else None
+        ahora = datetime.now()
+
+        eventos = [
+            (
+                ahora, usuario, entidad, entidad_id, campo,
+                _valor_auditoria(antes), _valor_auditoria(despues)
+            )
+            for campo, (antes, despues) in cambios.items()
+            if _valor_auditoria(antes) != _valor_auditoria(despues)
+        ]
+        if not eventos:
+            return
+
+        self._iniciar()
+
+        for i, evento in enumerate(eventos):
+            try:
+                self.cola.put_nowait(evento)
+            except queue.Full:
+                # Buffer lleno: el request graba lo suyo. La ruta ya hizo
+                # commit: un error acá se loguea, no convierte el cambio en 500
+                try:
+                    self._insertar(eventos[i:])
+                except Exception:
+                    app.logger.exception(
+                        "Auditoría: buffer lleno y no se pudieron grabar %s eventos",
+                        len(eventos) - i
+                    )
+                return
+
+    def _iniciar(self):
+        with self.lock:
+            if self.iniciado:
+                return
+            self.iniciado = True
+
+        threading.Thread(target=self._correr, name="auditoria", daemon=True).start()
+
+    def _tomar_lote(self, espera):
+        lote = []
+        try:
+            lote.append(self.cola.get(timeout=espera))
+        except queue.Empty:
+            return lote
+
+        while len(lote) < AUDITORIA_LOTE:
+            try:
+                lote.append(self.cola.get_nowait())
+            except queue.Empty:
+                break
+        return lote
+
+    def _insertar(self, eventos):
+        db = get_db()
+        cur = db.cursor()
+        try:
+            backend.ejecutar_varios(cur, """
+                INSERT INTO auditoria (
+                    fecha, usuario, entidad, entidad_id,
+                    campo, valor_anterior, valor_nuevo
+                )
+                VALUES %s
+            """, eventos, page_size=AUDITORIA_LOTE)
+            db.commit()
+        finally:
+            cur.close()
+            db.close()
+
+    def vaciar(self):
+        """Graba todo lo pendiente (al leer el historial y al apagar)."""
+        with self.grabando:
+            while True:
+                lote = self.fallido or self._tomar_lote(0)
+                if not lote:
+                    return
+
+                try:
+                    self._insertar(lote)
+                except Exception:
+                    # Se reintenta el mismo lote antes de tomar eventos nuevos
+                    self.fallido = lote
+                    raise
+
+                self.fallido = []
+
+    def _correr(self):
+        while True:
+            time.sleep(AUDITORIA_INTERVALO_SEG)
+            try:
+                self.vaciar()
+            except Exception:
+                app.logger.exception("Auditoría: no se pudo grabar el lote, se reintenta")
+
+
+auditoria = Auditoria()
+
+
+@atexit.register
+def _vaciar_auditoria():
+    if not auditoria.iniciado and not auditoria.fallido:
+        return
+    try:
+        auditoria.vaciar()
+    except Exception:
+        app.logger.exception("Auditoría: quedaron eventos sin grabar al apagar")
+
+
+@app.route("/auditoria/<entidad>/<int:entidad_id>")
+@login_required
+@clase_consulta("interactiva")
+def historial_auditoria(entidad, entidad_id):
+    if not current_user.es_admin:
+        abort(403)
+
+    if entidad not in ("guardias", "usuarios"):
+        abort(404)
+
+    auditoria.vaciar()
+
+    db = get_db()
+    cur = db.cursor()
+    cur.execute("""
+        SELECT fecha, usuario, campo, valor_anterior, valor_nuevo
+        FROM auditoria
+        WHERE entidad = %s
+        AND entidad_id = %s
+        ORDER BY fecha DESC, id DESC
+    """, (entidad, entidad_id))
+    cambios = cur.fetchall()
+    cur.close()
+    db.close()
+
+    return render_template(
+        "auditoria.html",
+        entidad=entidad,
+        entidad_id=entidad_id,
+        cambios=cambios
+    )
+
+
+# ================== ANALÍTICA (ROLLUPS) ==================
+# Tiempos de resolución pre-agregados por hora y por día, por guardia y
+# prioridad. Cada bucket guarda cantidad, suma de minutos y un histograma
+# con límites fijos (sumable entre buckets), así p50/p90 de un año salen de
+# unos cientos de filas y no de recorrer todos los llamados.
+#
+# Se mantienen en la misma transacción que resuelve / reabre el llamado.
+# Para cargarlos desde cero: flask rollups-reconstruir
+import bisect
+
+# Límites superiores (en minutos) de cada bin; el último bin es "más de 30 días"
+HISTOGRAMA_LIMITES = [
+    1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240, 360,
+    480, 720, 1440, 2880, 4320, 10080, 20160, 43200
+]
+GRANULARIDADES = ("hora", "dia")
+ANALITICA_MAX_DIAS = 400
+
+ESQUEMA_EXTRA.append("""
+    CREATE TABLE IF NOT EXISTS rollup_resoluciones (
+        granularidad TEXT NOT NULL,
+        bucket TIMESTAMP NOT NULL,
+        quien_guardia TEXT NOT NULL,
+        prioridad TEXT NOT NULL,
+        cantidad INTEGER NOT NULL DEFAULT 0,
+        suma_minutos DOUBLE PRECISION NOT NULL DEFAULT 0,
+        PRIMARY KEY (granularidad, bucket, quien_guardia, prioridad)
+    )
+""")
+ESQUEMA_EXTRA.append("""
+    CREATE TABLE IF NOT EXISTS rollup_histograma (
+        granularidad TEXT NOT NULL,
+        bucket TIMESTAMP NOT NULL,
+        quien_guardia TEXT NOT NULL,
+        prioridad TEXT NOT NULL,
+        bin INTEGER NOT NULL,
+        cantidad INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (granularidad, bucket, quien_guardia, prioridad, bin)
+    )
+""")
+
+
+def _inicio_bucket(fecha, granularidad):
+    if granularidad == "hora":
+        return fecha.replace(minute=0, second=0, microsecond=0)
+    return fecha.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _bin_minutos(minutos):
+    return bisect.bisect_left(HISTOGRAMA_LIMITES, minutos)
+
+
+def _cuenta_en_rollup(row):
+    """Un llamado suma al rollup si está Resuelto con fecha (mismo criterio que el dashboard)."""
+    return bool(
+        row
+        and row["estado"] == "Resuelto"
+        and row["fecha_resolucion"] is not None
+        and row["fecha_llamado"] is not None
+    )
+
+
+def _sumar_rollup(cur, row, signo):
+    minutos = max((row["fecha_resolucion"] - row["fecha_llamado"]).total_seconds() / 60, 0)
+    prioridad = row["prioridad"] or "Media"
+    bin_ = _bin_minutos(minutos)
+
+    resumen = []
+    histograma = []
+    for granularidad in GRANULARIDADES:
+        bucket = _inicio_bucket(row["fecha_resolucion"], granularidad)
+        resumen.append((granularidad, bucket, row["quien_guardia"], prioridad, signo, signo * minutos))
+        histograma.append((granularidad, bucket, row["quien_guardia"], prioridad, bin_, signo))
+
+    backend.ejecutar_varios(cur, """
+        INSERT INTO rollup_resoluciones (
+            granularidad, bucket, quien_guardia, prioridad, cantidad, suma_minutos
+        )
+        VALUES %s
+        ON CONFLICT (granularidad, bucket, quien_guardia, prioridad)
+        DO UPDATE SET
+            cantidad = rollup_resoluciones.cantidad + EXCLUDED.cantidad,
+            suma_minutos = rollup_resoluciones.suma_minutos + EXCLUDED.suma_minutos
+    """, resumen)
+
+    backend.ejecutar_varios(cur, """
+        INSERT INTO rollup_histograma (
+            granularidad, bucket, quien_guardia, prioridad, bin, cantidad
+        )
+        VALUES %s
+        ON CONFLICT (granularidad, bucket, quien_guardia, prioridad, bin)
+        DO UPDATE SET cantidad = rollup_histograma.cantidad + EXCLUDED.cantidad
+    """, histograma)
+
+
+def actualizar_rollup(cur, anterior, nuevo):
+    """
+    Aplica el cambio de un llamado a los rollups: resta lo que aportaba la
+    versión anterior y suma lo que aporta la nueva (None = no existía).
+    anterior tiene que haberse leído con backend.para_actualizar().
+    """
+    if _cuenta_en_rollup(anterior):
+        if (
+            _cuenta_en_rollup(nuevo)
+            and anterior["fecha_resolucion"] == nuevo["fecha_resolucion"]
+            and anterior["fecha_llamado"] == nuevo["fecha_llamado"]
+            and anterior["quien_guardia"] == nuevo["quien_guardia"]
+            and anterior["prioridad"] == nuevo["prioridad"]
+        ):
+            return
+        _sumar_rollup(cur, anterior, -1)
+
+    if _cuenta_en_rollup(nuevo):
+        _sumar_rollup(cur, nuevo, 1)
+
+
+def _reconstruir_rollups(cur):
+    cur.execute("DELETE FROM rollup_histograma")
+    cur.execute("DELETE FROM rollup_resoluciones")
+
+    minutos = f"GREATEST({backend.minutos_entre('fecha_llamado', 'fecha_resolucion')}, 0)"
+
+    for granularidad, trunc in (("hora", "hour"), ("dia", "day")):
+        bucket = backend.trunc(trunc, "fecha_resolucion")
+
+        cur.execute(f"""
+            INSERT INTO rollup_resoluciones (
+                granularidad, bucket, quien_guardia, prioridad, cantidad, suma_minutos
+            )
+            SELECT
+                %s,
+                {bucket},
+                quien_guardia,
+                COALESCE(prioridad, 'Media'),
+                COUNT(*),
+                SUM({minutos})
+            FROM guardias
+            WHERE estado = 'Resuelto'
+            AND fecha_resolucion IS NOT NULL
+            GROUP BY 2, 3, 4
+        """, (granularidad,))
+
+        # bin = cantidad de límites menores que los minutos (igual que _bin_minutos)
+        cur.execute(f"""
+            INSERT INTO rollup_histograma (
+                granularidad, bucket, quien_guardia, prioridad, bin, cantidad
+            )
+            SELECT %s, bucket, quien_guardia, prioridad, bin, COUNT(*)
+            FROM (
+                SELECT
+                    {bucket} AS bucket,
+                    quien_guardia,
+                    COALESCE(prioridad, 'Media') AS prioridad,
+                    {backend.bin_histograma(minutos)} AS bin
+                FROM guardias
+                WHERE estado = 'Resuelto'
+                AND fecha_resolucion IS NOT NULL
+            ) t
+            GROUP BY 1, 2, 3, 4, 5
+        """, (granularidad,))
+
+
+def _rellenar_rollups(cur):
+    # Rollups recién creados sobre llamados ya resueltos: se cargan antes de
+    # que la app empiece a restar de buckets vacíos
+    cur.execute("SELECT 1 FROM rollup_resoluciones LIMIT 1")
+    if cur.fetchone() is None:
+        _reconstruir_rollups(cur)
+
+
+DATOS_INICIALES.append(_rellenar_rollups)
+
+
+@app.cli.command("rollups-reconstruir")
+def rollups_reconstruir():
+    """Recalcula los rollups de analítica desde la tabla guardias."""
+    db = get_db("export")
+    cur = db.cursor()
+    _reconstruir_rollups(cur)
+    db.commit()
+    cur.close()
+    db.close()
+    click.echo("Rollups reconstruidos")
+
+
+def _percentil(histograma, p):
+    """Estima el percentil p (0-1) interpolando dentro del bin del histograma {bin: cantidad}."""
+    total = sum(histograma.values())
+    if not total:
+        return None
+
+    objetivo = p * total
+    acumulado = 0
+    for bin_ in sorted(histograma):
+        cantidad = histograma[bin_]
+        if acumulado + cantidad >= objetivo and cantidad > 0:
+            desde = HISTOGRAMA_LIMITES[bin_ - 1] if bin_ > 0 else 0
+            hasta = HISTOGRAMA_LIMITES[bin_] if bin_ < len(HISTOGRAMA_LIMITES) else desde * 2
+            return round(desde + (hasta - desde) * (objetivo - acumulado) / cantidad, 1)
+        acumulado += cantidad
+
+    return float(HISTOGRAMA_LIMITES[-1])
+
+
+def _parametros_analitica(args):
+    granularidad = args.get("granularidad", "dia")
+    if granularidad not in GRANULARIDADES:
+        granularidad = "dia"
+
+    hoy = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    default_dias = 2 if granularidad == "hora" else 30
+
+    try:
+        hasta = datetime.strptime(args["hasta"], "%Y-%m-%d") + timedelta(days=1) if args.get("hasta") else hoy + timedelta(days=1)
+        desde = datetime.strptime(args["desde"], "%Y-%m-%d") if args.get("desde") else hasta - timedelta(days=default_dias)
+    except ValueError:
+        abort(400)
+
+    # Acota el rango: por hora como mucho un mes, por día ~13 meses
+    max_dias = 31 if granularidad == "hora" else ANALITICA_MAX_DIAS
+    if (hasta - desde).days > max_dias:
+        desde = hasta - timedelta(days=max_dias)
+
+    return {
+        "granularidad": granularidad,
+        "desde": desde,
+        "hasta": hasta,
+        "guardia": args.get("guardia") or None,
+        "prioridad": args.get("prioridad") or None
+    }
+
+
+def _analitica(cur, p):
+    where = ["granularidad = %s", "bucket >= %s", "bucket < %s"]
+    params = [p["granularidad"], p["desde"], p["hasta"]]
+
+    if p["guardia"]:
+        where.append("quien_guardia = %s")
+        params.append(p["guardia"])
+
+    if p["prioridad"]:
+        where.append("prioridad = %s")
+        params.append(p["prioridad"])
+
+    where_sql = "WHERE " + " AND ".join(where)
+
+    # ======================
+    # SERIE (por bucket)
+    # ======================
+    cur.execute(f"""
+        SELECT bucket, SUM(cantidad) AS cantidad, SUM(suma_minutos) AS suma_minutos
+        FROM rollup_resoluciones
+        {where_sql}
+        GROUP BY bucket
+        HAVING SUM(cantidad) > 0
+        ORDER BY bucket
+    """, params)
+    serie = cur.fetchall()
+
+    cur.execute(f"""
+        SELECT bucket, bin, SUM(cantidad) AS cantidad
+        FROM rollup_histograma
+        {where_sql}
+        GROUP BY bucket, bin
+    """, params)
+    hist_bucket = {}
+    hist_total = {}
+    for r in cur.fetchall():
+        hist_bucket.setdefault(r["bucket"], {})[r["bin"]] = r["cantidad"]
+        hist_total[r["bin"]] = hist_total.get(r["bin"], 0) + r["cantidad"]
+
+    # ======================
+    # DESGLOSE (guardia / prioridad)
+    # ======================
+    cur.execute(f"""
+        SELECT quien_guardia, prioridad,
+               SUM(cantidad) AS cantidad, SUM(suma_minutos) AS suma_minutos
+        FROM rollup_resoluciones
+        {where_sql}
+        GROUP BY quien_guardia, prioridad
+        HAVING SUM(cantidad) > 0
+        ORDER BY quien_guardia, prioridad
+    """, params)
+    desglose = cur.fetchall()
+
+    cur.execute(f"""
+        SELECT quien_guardia, prioridad, bin, SUM(cantidad) AS cantidad
+        FROM rollup_histograma
+        {where_sql}
+        GROUP BY quien_guardia, prioridad, bin
+    """, params)
+    hist_desglose = {}
+    for r in cur.fetchall():
+        hist_desglose.setdefault((r["quien_guardia"], r["prioridad"]), {})[r["bin"]] = r["cantidad"]
+
+    def fila(r, hist):
+        cantidad = int(r["cantidad"])
+        return {
+            "cantidad": cantidad,
+            "promedio_min": round(r["suma_minutos"] / cantidad, 1) if cantidad else None,
+            "p50_min": _percentil(hist, 0.5),
+            "p90_min": _percentil(hist, 0.9)
+        }
+
+    total_cantidad = sum(int(r["cantidad"]) for r in serie)
+    total_minutos = sum(r["suma_minutos"] for r in serie)
+
+    return {
+        "granularidad": p["granularidad"],
+        "desde": p["desde"].isoformat(),
+        "hasta": p["hasta"].isoformat(),
+        "guardia": p["guardia"],
+        "prioridad": p["prioridad"],
+        "total": {
+            "cantidad": total_cantidad,
+            "promedio_min": round(total_minutos / total_cantidad, 1) if total_cantidad else None,
+            "p50_min": _percentil(hist_total, 0.5),
+            "p90_min": _percentil(hist_total, 0.9)
+        },
+        "serie": [
+            dict(bucket=r["bucket"].isoformat(), **fila(r, hist_bucket.get(r["bucket"], {})))
+            for r in serie
+        ],
+        "desglose": [
+            dict(
+                quien_guardia=r["quien_guardia"],
+                prioridad=r["prioridad"],
+                **fila(r, hist_desglose.get((r["quien_guardia"], r["prioridad"]), {}))
+            )
+            for r in desglose
+        ]
+    }
+
+
+@app.route("/analitica")
+@login_required
+@clase_consulta("dashboard")
+def analitica():
+    if not current_user.es_admin:
+        return redirect("/")
+
+    p = _parametros_analitica(request.args)
+
+    db = get_db()
+    cur = db.cursor()
+    datos = _analitica(cur, p)
+
+    # Solo de los rollups: la lista de guardias sale de ahí también
+    cur.execute("""
+        SELECT DISTINCT quien_guardia
+        FROM rollup_resoluciones
+        WHERE granularidad = 'dia'
+        ORDER BY quien_guardia
+    """)
+    guardias_disponibles = cur.fetchall()
+    cur.close()
+    db.close()
+
+    return render_template(
+        "analitica.html",
+        datos=datos,
+        guardias_disponibles=guardias_disponibles,
+        guardia_filtro=p["guardia"],
+        prioridad_filtro=p["prioridad"],
+        granularidad=p["granularidad"],
+        desde=p["desde"].strftime("%Y-%m-%d"),
+        hasta=(p["hasta"] - timedelta(days=1)).strftime("%Y-%m-%d")
+    )
+
+
+@app.route("/api/analitica")
+@login_required
+@clase_consulta("dashboard")
+def api_analitica():
+    if not current_user.es_admin:
+        return jsonify({"error": "No autorizado"}), 403
+
+    p = _parametros_analitica(request.args)
+
+    db = get_db()
+    cur = db.cursor()
+    datos = _analitica(cur, p)
+    cur.close()
+    db.close()
+
+    return jsonify(datos)
+
+
+# ================== CONTEOS ==================
+# Contar filas puede salir más caro que traer la página. Cada ruta elige:
+#   exacto   -> COUNT(*) de siempre
+#   tope     -> cuenta hasta CONTEO_UMBRAL y después muestra "1000+"
+#   estimado -> como tope, pero arriba del umbral usa la estimación del
+#               planner ("~12345"; en SQLite queda el tope)
+#   cache    -> exacto, guardado en memoria y recalculado en segundo plano
+#               cuando tiene más de CONTEO_CACHE_REFRESCO_SEG
+CONTEO_UMBRAL = int(os.environ.get("CONTEO_UMBRAL", 1000))
+CONTEO_CACHE_REFRESCO_SEG = int(os.environ.get("CONTEO_CACHE_REFRESCO_SEG", 30))
+CONTEO_CACHE_MAX_SEG = int(os.environ.get("CONTEO_CACHE_MAX_SEG", 600))
+
+
+class Conteo:
+    def __init__(self, valor, exacto=True, estimado=False):
+        self.valor = valor
+        self.exacto = exacto
+        self.estimado = estimado
+
+    @classmethod
+    def con_tope(cls, valor, umbral):
+        """valor contado con LIMIT umbral + 1."""
+        if valor <= umbral:
+            return cls(valor)
+        return cls(umbral, exacto=False)
+
+    def __str__(self):
+        """Lo que muestra la página: "1000+" con tope, "~N" estimado."""
+        if self.exacto:
+            return str(self.valor)
+        if self.estimado:
+            return f"~{self.valor}"
+        return f"{self.valor}+"
+
+
+cache_conteos = crear_cache("conteos", 512, CONTEO_CACHE_MAX_SEG)
+_conteos_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="conteo")
+_conteos_en_curso = set()
+_conteos_lock = threading.Lock()
+
+
+def _contar_exacto(cur, desde_sql, params):
+    cur.execute(f"SELECT COUNT(*) AS total {desde_sql}", params)
+    return cur.fetchone()["total"]
+
+
+def _contar_con_tope(cur, desde_sql, params, tope):
+    cur.execute(f"""
+        SELECT COUNT(*) AS total
+        FROM (SELECT 1 {desde_sql} LIMIT %s) t
+    """, list(params) + [tope + 1])
+    return cur.fetchone()["total"]
+
+
+def _refrescar_conteo(clave, desde_sql, params):
+    try:
+        # Fuera de un request no hay teardown que la devuelva al pool: se
+        # cierra también si el COUNT falla (statement_timeout)
+        db = get_db("dashboard")
+        cur = db.cursor()
+        try:
+            cache_conteos.set(clave, (_contar_exacto(cur, desde_sql, params), time.time()))
+        finally:
+            cur.close()
+            db.close()
+    except Exception:
+        app.logger.exception("No se pudo refrescar el conteo en segundo plano")
+    finally:
+        with _conteos_lock:
+            _conteos_en_curso.discard(clave)
+
+
+def contar(cur, desde_sql, params, estrategia="exacto", umbral=None):
+    """
+    Cuenta las filas de desde_sql ("FROM guardias WHERE ...") con la
+    estrategia pedida. Devuelve un Conteo (valor + si es exacto).
+    """
+    umbral = umbral or CONTEO_UMBRAL
+
+    if estrategia == "exacto":
+        return Conteo(_contar_exacto(cur, desde_sql, params))
+
+    if estrategia in ("tope", "estimado"):
+        conteo = Conteo.con_tope(_contar_con_tope(cur, desde_sql, params, umbral), umbral)
+
+        if not conteo.exacto and estrategia == "estimado":
+            estimado = backend.estimar_filas(cur, desde_sql, params)
+            if estimado is not None:
+                return Conteo(max(estimado, umbral + 1), exacto=False, estimado=True)
+
+        return conteo
+
+    if estrategia == "cache":
+        clave = (desde_sql, tuple(params))
+        guardado = cache_conteos.get(clave)
+
+        if guardado is None:
+            valor = _contar_exacto(cur, desde_sql, params)
+            cache_conteos.set(clave, (valor, time.time()))
+            return Conteo(valor)
+
+        valor, calculado = guardado
+        if time.time() - calculado > CONTEO_CACHE_REFRESCO_SEG:
+            with _conteos_lock:
+                refrescar = clave not in _conteos_en_curso
+                _conteos_en_curso.add(clave)
+            if refrescar:
+                _conteos_pool.submit(_refrescar_conteo, clave, desde_sql, list(params))
+
+        return Conteo(valor)
+
+    raise ValueError(f"Estrategia de conteo desconocida: {estrategia}")
+
+
+# ================== RESUMEN MENSUAL ==================
+# Llamados por mes, guardia, prioridad y estado con subtotales (ROLLUP) y
+# tiempo promedio de resolución. Los meses cerrados se calculan una vez y se
+# guardan en resumen_mensual; solo el mes en curso se recalcula en cada
+# pedido. Un llamado de un mes cerrado puede seguir abierto: las rutas que
+# crean / editan / resuelven llamados invalidan el mes guardado del llamado
+# (invalidar_resumen). POST /reporte/resumen/recalcular invalida el rango.
+#
+# Invalidar no borra la fila: sube su version (la crea si no existe). Un mes
+# vale si version_calculo = version, y quien lo calcula solo lo guarda si la
+# version no cambió desde que la leyó. Así un cálculo que arrancó antes de
+# que se confirme un cambio no pisa la invalidación con datos viejos.
+#   /reporte/resumen?desde=2025-01&hasta=2025-12[&formato=csv]
+
+# GROUPING(quien_guardia, prioridad, estado) -> nivel de subtotal
+NIVELES_RESUMEN = {
+    0: "Detalle",
+    1: "Subtotal guardia + prioridad",
+    3: "Subtotal guardia",
+    7: "Total mes"
+}
+RESUMEN_MESES_DEFAULT = 12
+RESUMEN_MESES_MAX = 36
+ORDEN_PRIORIDAD = {"Alta": 1, "Media": 2, "Baja": 3}
+
+ESQUEMA_EXTRA.append("""
+    CREATE TABLE IF NOT EXISTS resumen_mensual (
+        mes TEXT PRIMARY KEY,
+        filas TEXT NOT NULL,
+        fecha_calculo TIMESTAMP NOT NULL,
+        version INTEGER NOT NULL DEFAULT 0,
+        version_calculo INTEGER NOT NULL DEFAULT 0
+    )
+""")
+ESQUEMA_EXTRA.append("""
+    ALTER TABLE resumen_mensual ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0
+""")
+ESQUEMA_EXTRA.append("""
+    ALTER TABLE resumen_mensual ADD COLUMN IF NOT EXISTS version_calculo INTEGER NOT NULL DEFAULT 0
+""")
+
+
+def invalidar_resumen(cur, *fechas_llamado):
+    """Invalida el resumen guardado de los meses de esos llamados (misma transacción)."""
+    meses = sorted({f.strftime("%Y-%m") for f in fechas_llamado if f is not None})
+    if meses:
+        ahora = datetime.now()
+        params = []
+        for mes in meses:
+            params.extend((mes, ahora))
+        # Si el mes no estaba guardado igual queda la fila con version 1: un
+        # cálculo en curso (que leyó version 0) ya no la puede guardar
+        cur.execute(f"""
+            INSERT INTO resumen_mensual (mes, filas, fecha_calculo, version, version_calculo)
+            VALUES {', '.join(["(%s, '[]', %s, 1, 0)"] * len(meses))}
+            ON CONFLICT (mes) DO UPDATE SET version = resumen_mensual.version + 1
+        """, params)
+
+
+def _sumar_meses(fecha, meses):
+    total = fecha.year * 12 + fecha.month - 1 + meses
+    return fecha.replace(year=total // 12, month=total % 12 + 1, day=1)
+
+
+def _sql_resumen():
+    """SELECT del resumen por mes. Sin ROLLUP (SQLite) se arma con UNION ALL por nivel."""
+    mes = backend.trunc("month", "fecha_llamado")
+    resuelto = "estado = 'Resuelto' AND fecha_resolucion IS NOT NULL"
+    medidas = f"""
+        COUNT(*) AS cantidad,
+        SUM(CASE WHEN {resuelto} THEN 1 ELSE 0 END) AS resueltos,
+        SUM(CASE WHEN {resuelto} THEN {backend.minutos_entre("fecha_llamado", "fecha_resolucion")} ELSE 0 END) AS suma_minutos
+    """
+    where = "WHERE fecha_llamado >= %s AND fecha_llamado < %s"
+
+    if backend.soporta_rollup:
+        return f"""
+            SELECT {mes} AS mes, quien_guardia, prioridad, estado,
+                   GROUPING(quien_guardia, prioridad, estado) AS nivel,
+                   {medidas}
+            FROM guardias
+            {where}
+            GROUP BY {mes}, ROLLUP(quien_guardia, prioridad, estado)
+        """, 1
+
+    columnas = ("quien_guardia", "prioridad", "estado")
+    partes = []
+    for nivel, agrupadas in ((0, 3), (1, 2), (3, 1), (7, 0)):
+        select_cols = [
+            c if i < agrupadas else f"NULL AS {c}"
+            for i, c in enumerate(columnas)
+        ]
+        partes.append(f"""
+            SELECT {mes} AS mes, {", ".join(select_cols)}, {nivel} AS nivel, {medidas}
+            FROM guardias
+            {where}
+            GROUP BY {", ".join([mes] + list(columnas[:agrupadas]))}
+        """)
+    return " UNION ALL ".join(partes), len(partes)
+
+
+def _calcular_resumen(cur, desde, hasta):
+    """Filas del resumen entre dos inicios de mes, agrupadas por 'YYYY-MM'."""
+    sql, repeticiones = _sql_resumen()
+    cur.execute(sql, [desde, hasta] * repeticiones)
+
+    por_mes = {}
+    for r in cur.fetchall():
+        mes = r["mes"]
+        if isinstance(mes, str):
+            mes = datetime.fromisoformat(mes)
+
+        por_mes.setdefault(mes.strftime("%Y-%m"), []).append({
+            "quien_guardia": r["quien_guardia"],
+            "prioridad": r["prioridad"],
+            "estado": r["estado"],
+            "nivel": int(r["nivel"]),
+            "cantidad": int(r["cantidad"]),
+            "resueltos": int(r["resueltos"] or 0),
+            "suma_minutos": float(r["suma_minutos"] or 0)
+        })
+    return por_mes
+
+
+def resumen_mensual(desde, hasta):
+    """
+    Resumen de los meses [desde, hasta] (inicios de mes). Los cerrados salen
+    de resumen_mensual (o se calculan y se guardan), el actual siempre fresco.
+    """
+    mes_actual = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    meses = []
+    mes = desde
+    while mes <= hasta:
+        meses.append(mes)
+        mes = _sumar_meses(mes, 1)
+
+    cerrados = [m.strftime("%Y-%m") for m in meses if m < mes_actual]
+
+    db = get_db()
+    cur = db.cursor()
+
+    resultado = {}
+    versiones = {}   # mes invalidado -> version leída
+    if cerrados:
+        cur.execute("""
+            SELECT mes, filas, version, version_calculo
+            FROM resumen_mensual
+            WHERE mes >= %s AND mes <= %s
+        """, (cerrados[0], cerrados[-1]))
+        for r in cur.fetchall():
+            if r["version_calculo"] == r["version"]:
+                resultado[r["mes"]] = json.loads(r["filas"])
+            else:
+                versiones[r["mes"]] = r["version"]
+
+    # Meses cerrados que faltan: una sola consulta sobre su rango
+    faltantes = [m for m in meses if m < mes_actual and m.strftime("%Y-%m") not in resultado]
+    if faltantes:
+        calculados = _calcular_resumen(cur, faltantes[0], _sumar_meses(faltantes[-1], 1))
+        ahora = datetime.now()
+
+        nuevos = []
+        for m in faltantes:
+            clave = m.strftime("%Y-%m")
+            resultado[clave] = calculados.get(clave, [])
+            version = versiones.get(clave, 0)
+            nuevos.append((clave, json.dumps(resultado[clave]), ahora, version, version))
+
+        # Solo se guarda si nadie invalidó el mes mientras se calculaba
+        backend.ejecutar_varios(cur, """
+            INSERT INTO resumen_mensual (mes, filas, fecha_calculo, version, version_calculo)
+            VALUES %s
+            ON CONFLICT (mes) DO UPDATE
+            SET filas = excluded.filas,
+                fecha_calculo = excluded.fecha_calculo,
+                version_calculo = excluded.version_calculo
+            WHERE resumen_mensual.version = excluded.version
+        """, nuevos)
+
+    if meses[-1] >= mes_actual:
+        clave = mes_actual.strftime("%Y-%m")
+        resultado[clave] = _calcular_resumen(cur, mes_actual, _sumar_meses(mes_actual, 1)).get(clave, [])
+
+    db.commit()
+    cur.close()
+    db.close()
+
+    filas = []
+    for clave in sorted(resultado):
+        for f in resultado[clave]:
+            filas.append(dict(f, mes=clave))
+
+    # Dentro del mes: cada guardia con su detalle y subtotales, el total al final
+    filas.sort(key=lambda f: (
+        f["mes"],
+        f["quien_guardia"] is None,
+        f["quien_guardia"] or "",
+        f["prioridad"] is None,
+        ORDEN_PRIORIDAD.get(f["prioridad"], 9),
+        f["estado"] is None,
+        f["estado"] or ""
+    ))
+
+    for f in filas:
+        f["tipo"] = NIVELES_RESUMEN[f["nivel"]]
+        f["promedio_min"] = round(f["suma_minutos"] / f["resueltos"], 1) if f["resueltos"] else None
+
+    return filas
+
+
+def _meses_resumen(args):
+    mes_actual = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    try:
+        hasta = datetime.strptime(args["hasta"], "%Y-%m") if args.get("hasta") else mes_actual
+        desde = datetime.strptime(args["desde"], "%Y-%m") if args.get("desde") else _sumar_meses(hasta, 1 - RESUMEN_MESES_DEFAULT)
+    except ValueError:
+        abort(400)
+
+    if desde > hasta:
+        abort(400)
+
+    if (hasta.year - desde.year) * 12 + hasta.month - desde.month >= RESUMEN_MESES_MAX:
+        desde = _sumar_meses(hasta, 1 - RESUMEN_MESES_MAX)
+
+    return desde, hasta
+
+
+@app.route("/reporte/resumen")
+@login_required
+@clase_consulta("dashboard")
+def reporte_resumen():
+    if not current_user.es_admin:
+        abort(403)
+
+    desde, hasta = _meses_resumen(request.args)
+    filas = resumen_mensual(desde, hasta)
+
+    if request.args.get("formato") != "csv":
+        return render_template(
+            "resumen_mensual.html",
+            filas=filas,
+            desde=desde.strftime("%Y-%m"),
+            hasta=hasta.strftime("%Y-%m")
+        )
+
+    output = io.StringIO()
+    output.write("\ufeff")  # 🔥 CLAVE PARA EXCEL
+
+    writer = csv.writer(output)
+    writer.writerow([
+        "Mes",
+        "Tipo",
+        "Guardia",
+        "Prioridad",
+        "Estado",
+        "Llamados",
+        "Resueltos",
+        "Tiempo promedio resolución (min)"
+    ])
+
+    for f in filas:
+        writer.writerow([
+            f["mes"],
+            f["tipo"],
+            f["quien_guardia"] or "",
+            f["prioridad"] or "",
+            f["estado"] or "",
+            f["cantidad"],
+            f["resueltos"],
+            f["promedio_min"] if f["promedio_min"] is not None else ""
+        ])
+
+    return Response(
+        output.getvalue(),
+        mimetype="text/csv",
+        headers={
+            "Content-Disposition": f"attachment; filename=resumen_{desde:%Y-%m}_{hasta:%Y-%m}.csv"
+        }
+    )
+
+
+@app.route("/reporte/resumen/recalcular", methods=["POST"])
+@login_required
+@clase_consulta("escritura")
+def recalcular_resumen():
+    if not current_user.es_admin:
+        abort(403)
+
+    desde, hasta = _meses_resumen(request.form)
+
+    db = get_db()
+    cur = db.cursor()
+    cur.execute(
+        "UPDATE resumen_mensual SET version = version + 1 WHERE mes >= %s AND mes <= %s",
+        (desde.strftime("%Y-%m"), hasta.strftime("%Y-%m"))
+    )
+    db.commit()
+    cur.close()
+    db.close()
+
+    return redirect(url_for("reporte_resumen", desde=f"{desde:%Y-%m}", hasta=f"{hasta:%Y-%m}"))
+
+
+# ================== API JSON ==================
+# Lista de llamados para el wallboard / integraciones, sin scrapear HTML:
+#   GET  /api/guardias?guardia=&estado=&resueltos=&q=&desde=&hasta=
+#                     &fields=id,estado,...&limit=50&cursor=...
+#   GET  /api/guardias/ids?ids=1,2,3      (o POST con {"ids": [...]})
+# Paginación por cursor (fecha_llamado, id) en lugar de OFFSET, proyección
+# de columnas con fields= y respuesta gzip si el cliente la acepta.
+import base64
+
+CAMPOS_API = (
+    "id", "quien_llamo", "fecha_llamado", "quien_guardia", "descripcion",
+    "prioridad", "fecha_registro", "fecha_resolucion", "derivado",
+    "derivado_a", "estado", "resolucion", "fecha_escalado"
+)
+API_LIMIT_DEFAULT = 50
+API_LIMIT_MAX = 500
+API_IDS_MAX = 200
+API_GZIP_MIN_BYTES = 1024
+
+ESQUEMA_EXTRA.append("""
+    CREATE INDEX IF NOT EXISTS idx_guardias_fecha_llamado_id
+    ON guardias (fecha_llamado DESC, id DESC)
+""")
+
+
+def _campos_api(args):
+    fields = args.get("fields")
+    if not fields:
+        return list(CAMPOS_API)
+
+    campos = [c.strip() for c in fields.split(",") if c.strip()]
+    invalidos = [c for c in campos if c not in CAMPOS_API]
+    if invalidos:
+        _error_api(f"Campos desconocidos: {', '.join(invalidos)}")
+    return campos
+
+
+def _serializar_guardia(row, campos):
+    item = {}
+    for campo in campos:
+        valor = row[campo]
+        if isinstance(valor, datetime):
+            valor = valor.isoformat()
+        item[campo] = valor
+    return item
+
+
+def _codificar_cursor(row):
+    crudo = json.dumps([row["fecha_llamado"].isoformat(), row["id"]])
+    return base64.urlsafe_b64encode(crudo.encode()).decode().rstrip("=")
+
+
+def _decodificar_cursor(cursor):
+    try:
+        crudo = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        fecha, guardia_id = json.loads(crudo)
+        return datetime.fromisoformat(fecha), int(guardia_id)
+    except (ValueError, TypeError):
+        _error_api("cursor inválido")
+
+
+def respuesta_json(datos, status=200):
+    """JSON comprimido con gzip cuando el cliente lo acepta y vale la pena."""
+    cuerpo = json.dumps(datos, ensure_ascii=False).encode("utf-8")
+    headers = {"Vary": "Accept-Encoding"}
+
+    if len(cuerpo) >= API_GZIP_MIN_BYTES and "gzip" in request.headers.get("Accept-Encoding", ""):
+        cuerpo = gzip.compress(cuerpo, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+
+    return Response(cuerpo, status=status, mimetype="application/json", headers=headers)
+
+
+def _error_api(mensaje, status=400):
+    """Corta el request con un error en JSON (no la página HTML de Werkzeug)."""
+    abort(respuesta_json({"error": mensaje}, status))
+
+
+@app.errorhandler(400)
+def _error_400(e):
+    # 400 que salen de código compartido con las vistas HTML (filtros de fecha)
+    if request.path.startswith("/api/"):
+        return respuesta_json({"error": e.description}, 400)
+    return e
+
+
+@app.route("/api/guardias")
+@login_required
+@clase_consulta("interactiva")
+def api_guardias():
+    campos = _campos_api(request.args)
+    limit = min(max(request.args.get("limit", API_LIMIT_DEFAULT, type=int), 1), API_LIMIT_MAX)
+
+    where, params, _ = _filtros_guardias(request.args)
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        fecha, guardia_id = _decodificar_cursor(cursor)
+        where.append("(fecha_llamado < %s OR (fecha_llamado = %s AND id < %s))")
+        params.extend([fecha, fecha, guardia_id])
+
+    where_sql = "WHERE " + " AND ".join(where) if where else ""
+
+    # id y fecha_llamado siempre: arman el cursor de la página siguiente
+    columnas = ", ".join(dict.fromkeys(["id", "fecha_llamado"] + campos))
+
+    db = get_db()
+    cur = db.cursor()
+    cur.execute(f"""
+        SELECT {columnas}
+        FROM guardias
+        {where_sql}
+        ORDER BY fecha_llamado DESC, id DESC
+        LIMIT %s
+    """, params + [limit + 1])
+    rows = cur.fetchall()
+    cur.close()
+    db.close()
+
+    siguiente = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        siguiente = _codificar_cursor(rows[-1])
+
+    return respuesta_json({
+        "items": [_serializar_guardia(r, campos) for r in rows],
+        "next_cursor": siguiente,
+        "limit": limit
+    })
+
+
+@app.route("/api/guardias/ids", methods=["GET", "POST"])
+@login_required
+@clase_consulta("interactiva")
+def api_guardias_ids():
+    campos = _campos_api(request.args)
+
+    if request.method == "POST":
+        cuerpo = request.get_json(silent=True)
+        if not isinstance(cuerpo, dict):
+            _error_api('El cuerpo tiene que ser un objeto JSON: {"ids": [...]}')
+        ids = cuerpo.get("ids", [])
+        if not isinstance(ids, list):
+            _error_api("ids tiene que ser una lista")
+    else:
+        ids = [i for i in request.args.get("ids", "").split(",") if i.strip()]
+
+    try:
+        ids = list(dict.fromkeys(int(i) for i in ids))
+    except (TypeError, ValueError):
+        _error_api("ids inválidos")
+
+    if len(ids) > API_IDS_MAX:
+        _error_api(f"Como máximo {API_IDS_MAX} ids por pedido")
+
+    if not ids:
+        return respuesta_json({"items": [], "no_encontrados": []})
+
+    where = ["id IN (" + ", ".join(["%s"] * len(ids)) + ")"]
+    params = list(ids)
+
+    if not current_user.es_admin:
+        where.append("quien_guardia = %s")
+        params.append(current_user.username)
+
+    db = get_db()
+    cur = db.cursor()
+    cur.execute(f"""
+        SELECT {", ".join(dict.fromkeys(["id"] + campos))}
+        FROM guardias
+        WHERE {" AND ".join(where)}
+    """, params)
+    rows = {r["id"]: r for r in cur.fetchall()}
+    cur.close()
+    db.close()
+
+    return respuesta_json({
+        "items": [_serializar_guardia(rows[i], campos) for i in ids if i in rows],
+        "no_encontrados": [i for i in ids if i not in rows]
+    })
+
+
+# ================== BENCHMARK SENTENCIAS PREPARADAS ==================
+# flask bench-preparadas: latencia de cada sentencia de SENTENCIAS_PREPARADAS
+# en tres modos (texto con conexión nueva / texto con el pool / preparada con
+# el pool) contra DATABASE_URL. Las escrituras se descartan con rollback.
+def _params_bench(cur):
+    cur.execute("""
+        SELECT u.id, u.username, g.id AS guardia_id
+        FROM usuarios u
+        JOIN guardias g ON g.quien_guardia = u.username
+        WHERE u.activo = true
+        ORDER BY u.id
+        LIMIT 1
+    """)
+    fila = cur.fetchone()
+    if not fila:
+        raise click.ClickException("La base no tiene usuarios activos con llamados")
+
+    ahora = datetime.now()
+    return {
+        "usuario_por_id": (fila["id"],),
+        "login_usuario": (fila["username"],),
+        "historial_propio_contar": (fila["username"], CONTEO_UMBRAL + 1),
+        "historial_propio_todo": (fila["username"],),
+        "historial_propio_pagina": (fila["username"], 10, 0),
+        "guardia_para_resolver": (fila["guardia_id"],),
+        "guardia_resolver": (fila["guardia_id"],),
+        "guardia_insertar": (
+            "Benchmark", ahora, fila["username"], "Benchmark", "Baja",
+            ahora, None, False, None, "Abierto"
+        )
+    }
+
+
+def _medir_modo(nombre, params, modo, iteraciones):
+    tiempos = []
+
+    for i in range(iteraciones + 10):
+        inicio = time.perf_counter()
+
+        db = get_db(dedicada=(modo == "nueva"))
+        cur = db.cursor()
+        if modo == "preparada":
+            ejecutar_preparada(cur, nombre, params)
+        else:
+            cur.execute(
+                SENTENCIAS_PREPARADAS[nombre].replace("{para_actualizar}", backend.para_actualizar(cur)),
+                params
+            )
+        cur.fetchall()
+        db.rollback()
+        cur.close()
+        db.close()
+
+        # Las primeras vueltas calientan el pool y preparan las sentencias
+        if i >= 10:
+            tiempos.append((time.perf_counter() - inicio) * 1000)
+
+    tiempos.sort()
+    return (
+        sum(tiempos) / len(tiempos),
+        tiempos[len(tiempos) // 2],
+        tiempos[int(len(tiempos) * 0.95)]
+    )
+
+
+@app.cli.command("bench-preparadas")
+@click.option("--iteraciones", default=500, show_default=True)
+def bench_preparadas(iteraciones):
+    """Compara latencia: conexión nueva vs pool vs sentencia preparada."""
+    db = get_db()
+    cur = db.cursor()
+    params = _params_bench(cur)
+    cur.close()
+    db.close()
+
+    modos = (
+        ("nueva", "texto, conexión nueva"),
+        ("pool", "texto, pool"),
+        ("preparada", "preparada, pool")
+    )
+
+    click.echo(f"Backend: {backend.nombre} — {iteraciones} iteraciones por modo (ms)")
+    click.echo(f"{'SENTENCIA':<26} {'MODO':<22} {'MEDIA':>8} {'P50':>8} {'P95':>8}")
+
+    for nombre in SENTENCIAS_PREPARADAS:
+        for modo, etiqueta in modos:
+            media, p50, p95 = _medir_modo(nombre, params[nombre], modo, iteraciones)
+            click.echo(f"{nombre:<26} {etiqueta:<22} {media:>8.3f} {p50:>8.3f} {p95:>8.3f}")
+
+
+
+# ================== PERFILADO BAJO DEMANDA ==================
+# Con PERFILADO_ACTIVO=1 un admin puede perfilar un request puntual mandando
+# el header "X-Perfilar: 1" o "?perfilar=1"; además se perfila al azar una
+# fracción PERFILADO_MUESTREO de todos los requests. El request corre con un
+# muestreador de pilas (un thread que mira el stack del request cada
+# PERFILADO_INTERVALO_MS) y tracemalloc. El perfil (tiempo repartido entre
+# SQL, plantillas, regex de resaltado y Python, pico de memoria y pilas en
+# formato "collapsed" para flamegraph) queda en PERFILES_DIR y se baja desde
+# /admin/perfiles. Sin PERFILADO_ACTIVO los hooks ni se registran.
+# tracemalloc es global: mientras se perfila, cuenta también lo que asignan
+# otros threads del proceso. Se perfila un request a la vez por proceso.
+import random
+import sys
+import tracemalloc
+import uuid
+from collections import Counter
+
+PERFILADO_ACTIVO = os.environ.get("PERFILADO_ACTIVO", "0") == "1"
+PERFILADO_MUESTREO = float(os.environ.get("PERFILADO_MUESTREO", 0))
+PERFILADO_INTERVALO_MS = float(os.environ.get("PERFILADO_INTERVALO_MS", 2))
+PERFILES_DIR = os.environ.get("PERFILES_DIR", os.path.join(app.root_path, "perfiles"))
+PERFILES_MAX = int(os.environ.get("PERFILES_MAX", 200))
+
+_perfilando = threading.Lock()
+_NOMBRE_PERFIL = re.compile(r"^[\w\-]+\.json$")
+
+
+def _categoria_frame(frame):
+    """Categoría del frame o None si es código Python común."""
+    code = frame.f_code
+    archivo = code.co_filename
+    nombre = getattr(code, "co_qualname", code.co_name)
+
+    if "psycopg2" in archivo or nombre.startswith(("CursorSQLite.", "ConexionSQLite.")):
+        return "sql"
+    if archivo.endswith(".html"):
+        return "plantillas"
+    if "jinja2" in archivo or archivo.endswith(os.path.join("flask", "templating.py")):
+        return "plantillas"
+    if code.co_name == "highlight":
+        # pattern.sub() es C: sus muestras caen en el frame de highlight()
+        return "regex"
+    return None
+
+
+class MuestreadorPilas(threading.Thread):
+    def __init__(self, thread_id, intervalo):
+        super().__init__(daemon=True, name="perfilador")
+        self.objetivo = thread_id
+        self.intervalo = intervalo
+        self.detener = threading.Event()
+        self.muestras = 0
+        self.categorias = Counter()
+        self.plantillas = Counter()
+        self.pilas = Counter()
+
+    def run(self):
+        while not self.detener.wait(self.intervalo):
+            frame = sys._current_frames().get(self.objetivo)
+            if frame is None:
+                continue
+
+            # La categoría la decide el frame más interno que tenga una
+            categoria = None
+            pila = []
+            while frame is not None:
+                code = frame.f_code
+                if categoria is None:
+                    categoria = _categoria_frame(frame)
+                    if categoria == "plantillas" and code.co_filename.endswith(".html"):
+                        self.plantillas[os.path.basename(code.co_filename)] += 1
+                pila.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+
+            self.muestras += 1
+            self.categorias[categoria or "python"] += 1
+            self.pilas[";".join(reversed(pila))] += 1
+
+    def parar(self):
+        self.detener.set()
+        self.join()
+
+
+def _debe_perfilar():
+    if PERFILADO_MUESTREO and random.random() < PERFILADO_MUESTREO:
+        return True
+
+    pedido = request.headers.get("X-Perfilar") == "1" or request.args.get("perfilar") == "1"
+    return pedido and current_user.is_authenticated and current_user.es_admin
+
+
+def _iniciar_perfil():
+    if not _debe_perfilar() or not _perfilando.acquire(blocking=False):
+        return
+
+    tracemalloc.start()
+    muestreador = MuestreadorPilas(threading.get_ident(), PERFILADO_INTERVALO_MS / 1000)
+    g.perfil = {"muestreador": muestreador, "inicio": time.perf_counter()}
+    muestreador.start()
+
+
+def _terminar_perfil():
+    perfil = g.pop("perfil", None)
+    if perfil is None:
+        return None
+
+    try:
+        muestreador = perfil["muestreador"]
+        muestreador.parar()
+        wall_ms = (time.perf_counter() - perfil["inicio"]) * 1000
+
+        _, pico = tracemalloc.get_traced_memory()
+        asignaciones = tracemalloc.take_snapshot().statistics("lineno")[:10]
+    finally:
+        tracemalloc.stop()
+        _perfilando.release()
+
+    muestras = muestreador.muestras or 1
+    return {
+        "ruta": request.full_path,
+        "metodo": request.method,
+        "usuario": current_user.username if current_user.is_authenticated else None,
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "wall_ms": round(wall_ms, 2),
+        "muestras": muestreador.muestras,
+        "intervalo_ms": PERFILADO_INTERVALO_MS,
+        # Tiempo de pared repartido según la proporción de muestras
+        "tiempo_ms": {
+            categoria: round(wall_ms * n / muestras, 2)
+            for categoria, n in muestreador.categorias.most_common()
+        },
+        "plantillas_ms": {
+            plantilla: round(wall_ms * n / muestras, 2)
+            for plantilla, n in muestreador.plantillas.most_common()
+        },
+        "memoria_pico_kb": round(pico / 1024, 1),
+        "asignaciones_top": [
+            {"linea": str(a.traceback), "kb": round(a.size / 1024, 1), "bloques": a.count}
+            for a in asignaciones
+        ],
+        # Formato "collapsed" (flamegraph.pl / speedscope): "pila muestras"
+        "pilas": [f"{pila} {n}" for pila, n in muestreador.pilas.most_common()]
+    }
+
+
+def _guardar_perfil(datos):
+    os.makedirs(PERFILES_DIR, exist_ok=True)
+    nombre = f"{datetime.now():%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:8]}.json"
+
+    with open(os.path.join(PERFILES_DIR, nombre), "w") as f:
+        json.dump(datos, f, ensure_ascii=False, indent=1)
+
+    # Se conservan los PERFILES_MAX más nuevos
+    perfiles = sorted(p for p in os.listdir(PERFILES_DIR) if _NOMBRE_PERFIL.match(p))
+    for viejo in perfiles[:-PERFILES_MAX]:
+        os.remove(os.path.join(PERFILES_DIR, viejo))
+
+    return nombre
+
+
+def _cerrar_perfil(response):
+    datos = _terminar_perfil()
+    if datos is not None:
+        datos["status"] = response.status_code
+        response.headers["X-Perfil"] = _guardar_perfil(datos)
+    return response
+
+
+def _cerrar_perfil_con_error(exc):
+    # Si la ruta explotó no pasa por after_request: igual se suelta todo
+    if exc is not None and g.get("perfil") is not None:
+        _terminar_perfil()
+
+
+if PERFILADO_ACTIVO:
+    app.before_request(_iniciar_perfil)
+    app.after_request(_cerrar_perfil)
+    app.teardown_request(_cerrar_perfil_con_error)
+
+
+@app.route("/admin/perfiles")
+@login_required
+def perfiles():
+    if not current_user.es_admin:
+        abort(403)
+
+    if not os.path.isdir(PERFILES_DIR):
+        return jsonify({"activo": PERFILADO_ACTIVO, "perfiles": []})
+
+    nombres = sorted(
+        (p for p in os.listdir(PERFILES_DIR) if _NOMBRE_PERFIL.match(p)),
+        reverse=True
+    )
+    return jsonify({
+        "activo": PERFILADO_ACTIVO,
+        "perfiles": [
+            {"nombre": n, "descarga_url": url_for("descargar_perfil", nombre=n)}
+            for n in nombres
+        ]
+    })
+
+
+@app.route("/admin/perfiles/<nombre>")
+@login_required
+def descargar_perfil(nombre):
+    if not current_user.es_admin:
+        abort(403)
+
+    ruta = os.path.join(PERFILES_DIR, nombre)
+    if not _NOMBRE_PERFIL.match(nombre) or not os.path.isfile(ruta):
+        abort(404)
+
+    return send_file(ruta, mimetype="application/json", as_attachment=True, download_name=nombre)
+
+
+
 
 
 if __name__ == "__main__":
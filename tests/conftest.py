@@ -0,0 +1,94 @@
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+# La app lee la configuración al importarse: la base temporal tiene que estar
+# en el entorno antes del import
+DIRECTORIO = tempfile.mkdtemp(prefix="guardias_tests_")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(DIRECTORIO, "tests.db")
+os.environ["REPORTES_DIR"] = os.path.join(DIRECTORIO, "reportes")
+os.environ["ESCALAMIENTO_ACTIVO"] = "0"
+os.environ["CACHE_BACKEND"] = "local"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+LLAMADOS = 300
+GUARDIAS = ("guardia1", "guardia2", "guardia3")
+PASSWORD = "presupuesto"
+
+
+def _sembrar(modulo):
+    db = modulo.get_db()
+    cur = db.cursor()
+
+    usuarios = [("admin", True)] + [(u, False) for u in GUARDIAS]
+    for username, es_admin in usuarios:
+        cur.execute("""
+            INSERT INTO usuarios (username, password, password_hash, es_admin, activo)
+            VALUES (%s, 'TEMP', %s, %s, true)
+        """, (username, generate_password_hash(PASSWORD, method="pbkdf2:sha256:1"), es_admin))
+
+    ahora = datetime.now()
+    estados = ("Abierto", "En progreso", "Resuelto", "Resuelto", "Cerrado")
+    prioridades = ("Alta", "Media", "Baja")
+    filas = []
+    for i in range(LLAMADOS):
+        fecha_llamado = ahora - timedelta(hours=7 * i)
+        estado = estados[i % len(estados)]
+        filas.append((
+            f"Usuario {i}",
+            fecha_llamado,
+            GUARDIAS[i % len(GUARDIAS)],
+            f"Problema de prueba {i}",
+            prioridades[i % len(prioridades)],
+            fecha_llamado,
+            fecha_llamado + timedelta(minutes=5 + i % 240) if estado == "Resuelto" else None,
+            False,
+            None,
+            estado
+        ))
+
+    modulo.backend.ejecutar_varios(cur, """
+        INSERT INTO guardias (
+            quien_llamo, fecha_llamado, quien_guardia, descripcion, prioridad,
+            fecha_registro, fecha_resolucion, derivado, derivado_a, estado
+        )
+        VALUES %s
+    """, filas)
+    db.commit()
+    cur.close()
+    db.close()
+
+
+@pytest.fixture(scope="session")
+def app_modulo():
+    """La app sobre una base SQLite temporal con esquema y datos de prueba."""
+    import app as modulo
+
+    modulo.asegurar_esquema()
+    _sembrar(modulo)
+
+    yield modulo
+
+    shutil.rmtree(DIRECTORIO, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def clientes(app_modulo):
+    """{rol: (cliente logueado, username)} para admin y un guardia común."""
+    clientes = {}
+    for rol, username in (("admin", "admin"), ("guardia", GUARDIAS[0])):
+        cliente = app_modulo.app.test_client()
+        resp = cliente.post("/login", data={"username": username, "password": PASSWORD})
+        # Sin sesión todas las rutas redirigen a /login y los presupuestos
+        # pasarían sin medir nada
+        assert resp.status_code == 302 and resp.headers["Location"].endswith("/"), (
+            f"login de {username} falló ({resp.status_code} -> {resp.headers.get('Location')})"
+        )
+        clientes[rol] = (cliente, username)
+    return clientes
@@ -0,0 +1,117 @@
+"""
+Presupuesto de consultas por ruta: cada ruta corre como admin y como guardia
+común contra la base de prueba (conftest.py), se cuentan sentencias SQL y
+filas leídas y el test falla si se pasa. Detecta un N+1 nuevo o un LIMIT que
+se perdió.
+
+Los presupuestos de filas no dependen de cuántos llamados tenga la base de
+prueba: una ruta que lee toda la tabla tiene que fallar. La única excepción
+es el export CSV, que lee todo a propósito (None = sin tope de filas).
+
+Los cachés (fragmentos, conteos) se vacían antes de cada request: se mide
+el peor caso.
+"""
+from datetime import datetime
+
+import pytest
+
+from conftest import GUARDIAS
+
+# (método, ruta, rol): (status esperado, máx. sentencias, máx. filas leídas)
+# Los POST que andan redirigen (302); las rutas que el guardia no puede ver
+# redirigen o devuelven 403
+PRESUPUESTOS_CONSULTAS = {
+    ("GET", "/", "admin"): (200, 4, 15),
+    ("GET", "/", "guardia"): (200, 3, 12),
+    ("GET", "/historial_guardias", "admin"): (200, 4, 15),
+    ("GET", "/historial_guardias", "guardia"): (200, 3, 12),
+    ("GET", "/dashboard", "admin"): (200, 8, 15),
+    ("GET", "/dashboard", "guardia"): (302, 1, 1),
+    ("GET", "/api/guardias", "admin"): (200, 2, 52),
+    ("GET", "/api/guardias", "guardia"): (200, 2, 52),
+    ("GET", "/usuarios", "admin"): (200, 2, 6),
+    ("GET", "/usuarios", "guardia"): (403, 1, 1),
+    ("GET", "/reporte/guardias", "admin"): (200, 2, None),
+    ("GET", "/reporte/guardias", "guardia"): (200, 2, None),
+    ("GET", "/nueva", "admin"): (200, 1, 1),
+    ("GET", "/nueva", "guardia"): (200, 1, 1),
+    ("POST", "/nueva", "admin"): (302, 4, 3),
+    ("POST", "/nueva", "guardia"): (302, 4, 3),
+    ("POST", "/resolver_guardia/<id>", "admin"): (302, 7, 3),
+    ("POST", "/resolver_guardia/<id>", "guardia"): (302, 7, 3)
+}
+
+FORMULARIO_NUEVA = {
+    "quien_llamo": "Presupuesto",
+    "fecha_llamado": datetime.now().strftime("%Y-%m-%dT%H:%M"),
+    "descripcion": "Llamado de prueba",
+    "prioridad": "Alta",
+    "estado": "Abierto",
+    "derivado_a": ""
+}
+
+
+class MedicionConsultas:
+    def __init__(self):
+        self.sentencias = 0
+        self.filas = 0
+
+
+def _guardia_abierta(app_modulo, username):
+    db = app_modulo.get_db()
+    cur = db.cursor()
+    cur.execute("""
+        SELECT id
+        FROM guardias
+        WHERE quien_guardia = %s
+        AND estado = 'Abierto'
+        ORDER BY id
+        LIMIT 1
+    """, (username,))
+    guardia_id = cur.fetchone()["id"]
+    cur.close()
+    db.close()
+    return guardia_id
+
+
+def _medir_request(app_modulo, cliente, metodo, url, data=None):
+    app_modulo.invalidar_cache_guardias()
+
+    medicion = MedicionConsultas()
+    app_modulo._medicion.actual = medicion
+    try:
+        resp = cliente.open(url, method=metodo, data=data)
+    finally:
+        app_modulo._medicion.actual = None
+
+    return resp.status_code, medicion
+
+
+@pytest.mark.parametrize(
+    "metodo, ruta, rol",
+    list(PRESUPUESTOS_CONSULTAS),
+    ids=[f"{m} {r} {rol}" for m, r, rol in PRESUPUESTOS_CONSULTAS]
+)
+def test_presupuesto_consultas(app_modulo, clientes, metodo, ruta, rol):
+    status_esperado, max_sentencias, max_filas = PRESUPUESTOS_CONSULTAS[(metodo, ruta, rol)]
+    cliente, username = clientes[rol]
+
+    url = ruta
+    if "<id>" in ruta:
+        # El admin resuelve un llamado ajeno; el guardia, uno propio
+        dueño = username if rol == "guardia" else GUARDIAS[1]
+        url = ruta.replace("<id>", str(_guardia_abierta(app_modulo, dueño)))
+    data = FORMULARIO_NUEVA if metodo == "POST" and ruta == "/nueva" else None
+
+    status, medicion = _medir_request(app_modulo, cliente, metodo, url, data)
+
+    # Un 302 a /login también mide casi 0 sentencias: el status tiene que ser
+    # el de la ruta, no el de una sesión perdida
+    assert status == status_esperado, f"status {status} (esperado {status_esperado})"
+    assert medicion.sentencias <= max_sentencias, (
+        f"{medicion.sentencias} sentencias SQL (presupuesto {max_sentencias})"
+    )
+    if max_filas is not None:
+        assert medicion.filas <= max_filas, (
+            f"{medicion.filas} filas leídas (presupuesto {max_filas})"
+        )